@@ -95,12 +95,12 @@ class AxiomsProblem(Problem):
         for i in range(len(terms)):
             fg = terms[i][0]
             flags_block = make_graph_block([fg], fg.n)
-            rarray = self._flag_cls.flag_products(graph_block, tg, flags_block, axiom_flags_block)
+            rarray, denominator = self._flag_cls.flag_products(graph_block, tg, flags_block, axiom_flags_block)
             for row in rarray:
                 gi = row[0]
                 j = row[1]  # always 0
                 k = row[2]
-                value = Integer(row[3]) / Integer(row[4])
+                value = Integer(row[3]) / denominator
                 quantum_graphs[k][gi] += value * terms[i][1]
         
         self._axioms.append((tg, terms))
@@ -66,15 +66,19 @@ cdef class GraphFlag (HypergraphFlag):
 
 
 	@classmethod
-	def generate_flags(cls, n, tg, forbidden_edge_numbers=None, forbidden_graphs=None, forbidden_induced_graphs=None):
+	def generate_flags(cls, n, tg, forbidden_edge_numbers=None, forbidden_graphs=None, forbidden_induced_graphs=None,
+		canonical_augmentation=False, processes=None):
 		return HypergraphFlag.generate_flags(n, tg, r=2, oriented=False, forbidden_edge_numbers=forbidden_edge_numbers,
-			forbidden_graphs=forbidden_graphs, forbidden_induced_graphs=forbidden_induced_graphs)
+			forbidden_graphs=forbidden_graphs, forbidden_induced_graphs=forbidden_induced_graphs, canonical_augmentation=canonical_augmentation,
+			processes=processes)
 
 
 	@classmethod
-	def generate_graphs(cls, n, forbidden_edge_numbers=None, forbidden_graphs=None, forbidden_induced_graphs=None):
+	def generate_graphs(cls, n, forbidden_edge_numbers=None, forbidden_graphs=None, forbidden_induced_graphs=None,
+		canonical_augmentation=False, processes=None):
 		return HypergraphFlag.generate_flags(n, cls(), r=2, oriented=False, forbidden_edge_numbers=forbidden_edge_numbers,
-			forbidden_graphs=forbidden_graphs, forbidden_induced_graphs=forbidden_induced_graphs)
+			forbidden_graphs=forbidden_graphs, forbidden_induced_graphs=forbidden_induced_graphs, canonical_augmentation=canonical_augmentation,
+			processes=processes)
 
 
 	def Graph(self):
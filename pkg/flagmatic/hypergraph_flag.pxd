@@ -58,6 +58,18 @@ cdef int *generate_combinations_plus(int n, int s, int *number_of)
 cdef int *generate_pair_combinations(int n, int s, int m1, int m2, int *number_of)
 cdef int *generate_equal_pair_combinations(int n, int s, int m, int *number_of)
 
+cdef struct packed_flags:
+	int len, r
+	int *ne
+	int *offsets
+	int *edges
+	int table_size
+	int *table
+
 cdef class graph_block:
 	cdef int n, len
 	cdef void **graphs
+	cdef bint is_packed
+	cdef packed_flags packed
+	cdef packed_flags *pack(self)
+	cdef int index_of(self, HypergraphFlag g)
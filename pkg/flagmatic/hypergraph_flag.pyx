@@ -43,9 +43,14 @@ DEF MAX_NUMBER_OF_EDGE_INTS = 256
 DEF MAX_NUMBER_OF_VERTICES = 35
 
 
-from libc.stdlib cimport malloc, calloc, realloc, free
-from libc.string cimport memset
+from libc.stdlib cimport malloc, calloc, realloc, free, qsort
+from libc.string cimport memset, memcpy
+from libc.stdint cimport uint64_t
 
+cdef extern from *:
+	int __builtin_popcountll(unsigned long long x)
+
+import fcntl, hashlib, multiprocessing, os, random, sys, tempfile, threading
 import numpy
 cimport numpy
 
@@ -54,6 +59,7 @@ from sage.combinat.all import Combinations, Permutations, Tuples, Subsets
 from sage.rings.all import Integer, QQ, ZZ
 from sage.matrix.all import matrix, block_matrix
 from sage.modules.misc import gram_schmidt
+from sage.misc.misc import DOT_SAGE
 		
 
 
@@ -199,6 +205,7 @@ cdef class HypergraphFlag (Flag):
 				raise ValueError("Too many vertices.")
 
 			self._n = value
+			self._certified_minimal_isomorph = False
 
 
 	property t:
@@ -217,6 +224,7 @@ cdef class HypergraphFlag (Flag):
 				raise ValueError
 
 			self._t = value
+			self._certified_minimal_isomorph = False
 
 
 	def add_edge(self, edge):
@@ -323,6 +331,7 @@ cdef class HypergraphFlag (Flag):
 		n = decode_symbol(s[0])
 		if n < 0 or n > MAX_NUMBER_OF_VERTICES:
 			raise ValueError("Unsupported number of vertices.")
+		self._certified_minimal_isomorph = False
 		self._n = n
 		self.ne = 0
 		nei = len(s) - 2
@@ -425,15 +434,17 @@ cdef class HypergraphFlag (Flag):
 		if not (op == 2 or op == 3):
 			return NotImplemented
 
-		g1 = self.__copy__()
-		g1.make_minimal_isomorph()
-		g2 = other.__copy__()
-		g2.make_minimal_isomorph()
+		# Flags that are both minimal isomorphs can be compared directly.
+		if self._certified_minimal_isomorph and other._certified_minimal_isomorph:
+			equal = self.is_labelled_isomorphic(other)
+		else:
+			equal = (self._r == other._r and self._oriented == other._oriented
+				and self.canonical_key() == other.canonical_key())
 
 		if op == 2: # ==
-			return g1.is_labelled_isomorphic(g2)
+			return equal
 		elif op == 3: # !=
-			return not g1.is_labelled_isomorphic(g2)
+			return not equal
 
 	
 	cpdef is_labelled_isomorphic(self, HypergraphFlag other):
@@ -474,7 +485,8 @@ cdef class HypergraphFlag (Flag):
 	
 
 	@classmethod
-	def generate_flags(cls, n, tg, r=3, oriented=False, multiplicity=1, forbidden_edge_numbers=None, forbidden_graphs=None, forbidden_induced_graphs=None):
+	def generate_flags(cls, n, tg, r=3, oriented=False, multiplicity=1, forbidden_edge_numbers=None, forbidden_graphs=None, forbidden_induced_graphs=None,
+		canonical_augmentation=False, processes=None):
 		"""
 		For an integer n, and a type tg, returns a list of all tg-flags on n
 		vertices, that satisfy certain constraints.
@@ -487,15 +499,41 @@ cdef class HypergraphFlag (Flag):
 		forbidden_induced_subgraphs should be a list of graphs that are forbidden as
 		_induced_ subgraphs.
 		
-		EXAMPLES:
+		The lists of flags are cached on disk (see flag_cache_directory), so they are
+		only generated once. To turn the cache off, set
+		flagmatic.hypergraph_flag.flag_cache_directory to None.
 		
+		If canonical_augmentation is True, then each extension of a smaller flag is only
+		kept if the new vertex is the canonical one to delete, so the flags are not
+		compared against all the flags found so far. The same flags are returned, but
+		they may be in a different order.
+		
+		If processes is an integer greater than 1, then the smaller flags are shared out
+		between that many worker processes, which extend them. The result is the same.
+		
+		EXAMPLES:
 		
+		Canonical augmentation gives the same flags, up to order (the cache is turned off,
+		so that both lists are really generated):
+		
+		sage: import flagmatic.hypergraph_flag as hypergraph_flag
+		sage: cache_directory = hypergraph_flag.flag_cache_directory
+		sage: hypergraph_flag.flag_cache_directory = None
+		sage: for cls, n, tg in [(GraphFlag, 6, GraphFlag("2:12")), (GraphFlag, 5, GraphFlag("3:")),
+		....:                    (ThreeGraphFlag, 5, ThreeGraphFlag("3:123"))]:
+		....:     flags = cls.generate_flags(n, tg)
+		....:     ca_flags = cls.generate_flags(n, tg, canonical_augmentation=True)
+		....:     print len(flags) == len(ca_flags), sorted(map(str, flags)) == sorted(map(str, ca_flags))
+		True True
+		True True
+		True True
+		sage: hypergraph_flag.flag_cache_directory = cache_directory
 		"""
 	
 		if not (r == 2 or r == 3):
 			raise NotImplementedError
 			
-		if oriented and r != 2:
+		if oriented and (r != 2 or multiplicity != 1):
 			raise NotImplementedError
 	
 		if tg is None:
@@ -517,73 +555,60 @@ cdef class HypergraphFlag (Flag):
 			ntg.t = s
 			return [ntg]
 	
-		max_ne = binomial(n - 1, r - 1) * multiplicity
-		max_e = binomial(n, r) * multiplicity
-		
-		new_graphs = []
-		hashes = set()
-		
+		key = flag_cache_key(n, tg, r, oriented, multiplicity, forbidden_edge_numbers, forbidden_graphs,
+			forbidden_induced_graphs, canonical_augmentation)
+		new_graphs = load_cached_flags(key, n, tg)
+		if not new_graphs is None:
+			return new_graphs
+
 		smaller_graphs = cls.generate_flags(n - 1, tg, r, oriented, multiplicity, forbidden_edge_numbers=forbidden_edge_numbers,
-			forbidden_graphs=forbidden_graphs, forbidden_induced_graphs=forbidden_induced_graphs)
-		
-		possible_edges = []
-	
-		if r == 3:
-			for c in Combinations(range(1, n), 2):
-				possible_edges.append((c[0], c[1], n))
-	
-		elif r == 2:
-			for x in range(1, n):
-				possible_edges.append((x, n))
-				if oriented:
-					possible_edges.append((n, x))
-	
-		if multiplicity > 1:
-			possible_edges = sum(([e] * multiplicity for e in possible_edges), [])
-	
-		for sg in smaller_graphs:
-		
-			pe = sg.ne
-			ds = sg.degrees()
-			maxd = max(ds[s:] + (0,))
-				
-			for ne in range(maxd, max_ne + 1):
-			
-				for nb in Combinations(possible_edges, ne):
-	
-					# For oriented graphs, can't have bidirected edges.
-					# TODO: exclude these in a more efficient way!
-					if oriented:
-						if any(e in nb and (e[1], e[0]) in nb for e in possible_edges):
-							continue
-							
-					ng = sg.__copy__()
-					ng.n = n
-					for e in nb:
-						ng.add_edge(e)
-	
-					if not forbidden_edge_numbers is None and ng.has_forbidden_edge_numbers(forbidden_edge_numbers, must_have_highest=True):
-						continue
-	
-					if not forbidden_graphs is None and ng.has_forbidden_graphs(forbidden_graphs, must_have_highest=True):
-						continue
-	
-					if not forbidden_induced_graphs is None and ng.has_forbidden_graphs(forbidden_induced_graphs, must_have_highest=True, induced=True):
-						continue
-	
-					ng.make_minimal_isomorph()
-					ng_hash = hash(ng)
-					if not ng_hash in hashes:
-						new_graphs.append(ng)
-						hashes.add(ng_hash)
-	
+			forbidden_graphs=forbidden_graphs, forbidden_induced_graphs=forbidden_induced_graphs,
+			canonical_augmentation=canonical_augmentation, processes=processes)
+
+		args = (n, s, r, oriented, multiplicity, forbidden_edge_numbers, forbidden_graphs, forbidden_induced_graphs,
+			canonical_augmentation)
+
+		if processes is None or processes < 2 or len(smaller_graphs) < 2:
+			extensions = extend_flags(args + (smaller_graphs,))
+
+		else:
+			# Contiguous chunks, so that the flags come out in the same order as above.
+			num_chunks = min(4 * processes, len(smaller_graphs))
+			chunks = [smaller_graphs[i * len(smaller_graphs) / num_chunks:(i + 1) * len(smaller_graphs) / num_chunks]
+				for i in range(num_chunks)]
+			pool = multiprocessing.Pool(processes)
+			try:
+				results = pool.map(extend_flags, [args + (chunk,) for chunk in chunks], chunksize=1)
+				pool.close()
+			except:
+				pool.terminate()
+				raise
+			finally:
+				pool.join()
+			extensions = sum(results, [])
+
+		new_graphs = []
+		keys = set()
+		for ng_key, ng in extensions:
+			if ng_key in keys:
+				continue
+			# the minimal isomorph was made before the flag was pickled
+			(<HypergraphFlag> ng)._certified_minimal_isomorph = True
+			new_graphs.append(ng)
+			# With canonical augmentation, extensions of different flags are never isomorphic.
+			if not canonical_augmentation:
+				keys.add(ng_key)
+
+		save_cached_flags(key, new_graphs)
 		return new_graphs
 
 
 	@classmethod
-	def generate_graphs(cls, n, r=3, oriented=False, multiplicity=1, forbidden_edge_numbers=None, forbidden_graphs=None, forbidden_induced_graphs=None):
+	def generate_graphs(cls, n, r=3, oriented=False, multiplicity=1, forbidden_edge_numbers=None, forbidden_graphs=None, forbidden_induced_graphs=None,
+		canonical_augmentation=False, processes=None):
 		return cls.generate_flags(n, cls(r=r, oriented=oriented, multiplicity=multiplicity), r, oriented, multiplicity, forbidden_edge_numbers=forbidden_edge_numbers,
-			forbidden_graphs=forbidden_graphs, forbidden_induced_graphs=forbidden_induced_graphs)
+			forbidden_graphs=forbidden_graphs, forbidden_induced_graphs=forbidden_induced_graphs, canonical_augmentation=canonical_augmentation,
+			processes=processes)
 
 
 	@classmethod
@@ -916,50 +941,78 @@ cdef class HypergraphFlag (Flag):
 
 
 	def make_minimal_isomorph(self):
-
-		cdef int i, *new_edges, *winning_edges, *e
-		cdef int *p, np, is_lower
-				
+		"""
+		Relabels the unlabelled vertices so that the edge list is the lexicographically
+		minimal one in the isomorphism class. The labelled vertices are left alone.
+		"""
 		self._require_mutable()
-		
+
 		if self._certified_minimal_isomorph:
 			return
-		
+
+		raw_make_minimal_isomorph(self._edges, self.ne, self._n, self._t, self._r, self._oriented)
+
+		self._certified_minimal_isomorph = True
+
+
+	def canonical_key(self):
+		"""
+		Returns a string that identifies the flag up to isomorphism (the labelled vertices
+		are fixed). Two flags with the same r and orientation have the same key if and only
+		if they are isomorphic. This is much cheaper to compute than the minimal isomorph.
+		"""
+		cdef HypergraphFlag g = self.__copy__()
+
+		raw_make_canonical_isomorph(g._edges, g.ne, g._n, g._t, g._r, g._oriented, NULL)
+		return g._repr_()
+
+
+	def make_minimal_isomorph_by_permutations(self):
+		"""
+		Does the same as make_minimal_isomorph, but by trying every permutation of the
+		unlabelled vertices. Only useful for checking make_minimal_isomorph (see
+		check_minimal_isomorphs).
+		"""
+		cdef int i, j, *new_edges, *winning_edges
+		cdef int *p, np, is_lower
+
+		self._require_mutable()
+
 		new_edges = <int *> malloc (sizeof(int) * self._r * self.ne)
 		winning_edges = <int *> malloc (sizeof(int) * self._r * self.ne)
-		
+
 		p = generate_permutations_fixing(self._n, self._t, &np)
-	
+
 		for i in range(np):
-		
+
 			for j in range(self._r * self.ne):
 				new_edges[j] = p[self._n * i + self._edges[j] - 1]
-		
+
 			raw_minimize_edges(new_edges, self.ne, self._r, self._oriented)
-	
+
 			if i == 0:
 				for j in range(self._r * self.ne):
 					winning_edges[j] = new_edges[j]
 				continue
-	
+
 			is_lower = 1
-	
+
 			for j in range(self._r * self.ne):
 				if new_edges[j] > winning_edges[j]:
 					is_lower = 0
 					break
 				elif new_edges[j] < winning_edges[j]:
 					break
-			
+
 			if is_lower: # We have a new winner
 				for j in range(self._r * self.ne):
 					winning_edges[j] = new_edges[j]
-		
+
 		for i in range(self._r * self.ne):
 			self._edges[i] = winning_edges[i]
-		
+
 		self._certified_minimal_isomorph = True
-		
+
 		free(new_edges)
 		free(winning_edges)
 
@@ -987,60 +1040,24 @@ cdef class HypergraphFlag (Flag):
 
 	cdef HypergraphFlag c_induced_subgraph(self, int *verts, int num_verts):
 
-		cdef int nm = 0, i, j, *e, got, te[3]
-		cdef HypergraphFlag ig = type(self)()
+		cdef int nm
+		cdef HypergraphFlag ig
 
 		if self.is_degenerate:
 			raise NotImplementedError("degenerate graphs are not supported.")
 
-		ig.n = num_verts
-		ig.r = self._r
-		ig.oriented = self._oriented
-		ig.multiplicity = self._multiplicity
-		ig.t = 0
-
-		if self._r == 3:
-		
-			for i in range(self.ne):
-				e = &self._edges[3 * i]
-				got = 0
-				for j in range(num_verts):
-					if e[0] == verts[j]:
-						got += 1
-						te[0] = j + 1
-					elif e[1] == verts[j]:
-						got += 1
-						te[1] = j + 1
-					elif e[2] == verts[j]:
-						got += 1
-						te[2] = j + 1
-				if got == 3:
-					e = &ig._edges[3 * nm]
-					e[0] = te[0]
-					e[1] = te[1]
-					e[2] = te[2]
-					nm += 1
-
-		elif self._r == 2:
+		# This is called very often, so __init__ and the property checks are skipped.
+		ig = type(self).__new__(type(self))
+		ig._n = num_verts
+		ig._r = self._r
+		ig._oriented = self._oriented
+		ig._multiplicity = self._multiplicity
+		ig._t = 0
 
-			for i in range(self.ne):
-				e = &self._edges[2 * i]
-				got = 0
-				for j in range(num_verts):
-					if e[0] == verts[j]:
-						got += 1
-						te[0] = j + 1
-					elif e[1] == verts[j]:
-						got += 1
-						te[1] = j + 1
-				if got == 2:
-					e = &ig._edges[2 * nm]
-					e[0] = te[0]
-					e[1] = te[1]
-					nm += 1
+		nm = raw_induced_edges(self._edges, self.ne, self._r, verts, num_verts, ig._edges)
 
 		ig.ne = nm
-		ig.minimize_edges()
+		raw_minimize_edges(ig._edges, nm, ig._r, ig._oriented)
 		return ig
 	
 
@@ -1049,82 +1066,44 @@ cdef class HypergraphFlag (Flag):
 		Determines if it contains h as a subgraph. Labels are ignored.
 		"""
 	
-		cdef int i, j, k, l, *p, np, *new_edges, *can_use, got_all, got_edge, got
+		cdef int i, *verts, *copies, result
+		cdef uint64_t *masks
 	
 		if self.is_degenerate:
 			raise NotImplementedError("degenerate graphs are not supported.")
 
 		if self._r != h._r or self._oriented != h._oriented:
 			raise ValueError
-			
-		new_edges = <int *> malloc (sizeof(int) * self._r * self.ne)
-		can_use = <int *> malloc (sizeof(int) * self.ne)
-		
-		p = generate_permutations(self._n, &np)
-	
-		for i in range(np):
-		
-			for j in range(self._r * self.ne):
-				new_edges[j] = p[self._n * i + self._edges[j] - 1]
-			
-			for j in range(self.ne):
-				can_use[j] = 1
-			
-			got_all = 1
-			for j in range(h.ne):
-				got_edge = 0
-				
-				if self._r == 3:
-					for k in range(self.ne):
-						if can_use[k] == 0:
-							continue
-						got = 0
-						for l in range(3):
-							if (h._edges[3 * j] == new_edges[(3 * k) + l] or 
-								h._edges[(3 * j) + 1] == new_edges[(3 * k) + l] or
-								h._edges[(3 * j) + 2] == new_edges[(3 * k) + l]):
-								got += 1
-						if got == 3:
-							got_edge = 1
-							can_use[k] = 0
-							break
-					if got_edge == 0:
-						got_all = 0
-						break
-				
-				elif self._r == 2:
-					for k in range(self.ne):
-						if can_use[k] == 0:
-							continue
-						if (h._edges[2 * j] == new_edges[2 * k]
-							and h._edges[2 * j + 1] == new_edges[2 * k + 1]) or (
-							not self._oriented and (h._edges[2 * j] == new_edges[2 * k + 1]
-							and h._edges[2 * j + 1] == new_edges[2 * k])):
-							got_edge = 1
-							can_use[k] = 0
-							break
-					if got_edge == 0:
-						got_all = 0
-						break						
-			
-			if got_all:
-				free(new_edges)
-				return 1
-	
-		free(new_edges)
-		return 0
+
+		if h._n > self._n:
+			return 0
+
+		verts = <int *> malloc(self._n * sizeof(int))
+		for i in range(self._n):
+			verts[i] = i + 1
+		masks = make_adjacency_masks(self)
+		copies = edge_copies(h)
+
+		result = contains_subgraph(masks, self, h, copies, verts, self._n)
+
+		free(verts)
+		free(masks)
+		free(copies)
+		return result
 
 
 	# TODO: ValueError on invalid forbidden_edge_numbers (currently they are ignored)
 	
 	def has_forbidden_edge_numbers(self, forbidden_edge_numbers, must_have_highest=False):
 	
-		cdef int *c, nc, i, j, k, l, fe, *edges, *e, got, *comb, num_e, max_e, ceiling
+		cdef int *c, nc, i, k, num_e, max_e, ceiling, *forbidden_edge_nums
+		cdef uint64_t *masks
 	
 		if self.is_degenerate:
 			raise NotImplementedError("degenerate graphs are not supported.")
 
 		forb_k = [pair[0] for pair in forbidden_edge_numbers]
+		masks = make_adjacency_masks(self)
 	
 		for k in range(self._r, self._n + 1): # only conditions in this range make sense
 
@@ -1150,80 +1129,34 @@ cdef class HypergraphFlag (Flag):
 					break
 			
 			if must_have_highest:
-			
-				c = generate_combinations(self._n - 1, k - 1, &nc)
-	
-				for i in range(nc):
-					comb = &c[(k - 1) * i]
-					num_e = 0
-					for j in range(self.ne):
-						got = 0
-						if self._r == 3:
-							e = &self._edges[3 * j]
-							for l in range(k - 1):
-								if comb[l] == e[0] or comb[l] == e[1] or comb[l] == e[2]:
-									got += 1
-							if self._n == e[0] or self._n == e[1] or self._n == e[2]:
-									got += 1
-							if got == 3:
-								num_e += 1
-								if num_e == ceiling:
-									return True
-						elif self._r == 2:
-							e = &self._edges[2 * j]
-							for l in range(k - 1):
-								if comb[l] == e[0] or comb[l] == e[1]:
-									got += 1
-							if self._n == e[0] or self._n == e[1]:
-									got += 1
-							if got == 2:
-								num_e += 1
-								if num_e == ceiling:
-									return True
-					if forbidden_edge_nums[num_e] == 1:
-						return True
-	
+				c = generate_combinations_plus(self._n, k, &nc)
 			else:
-	
 				c = generate_combinations(self._n, k, &nc)
-	
-				for i in range(nc):
-					comb = &c[k * i]
-					num_e = 0
-					for j in range(self.ne):
-						got = 0
-						if self._r == 3:
-							e = &self._edges[3 * j]
-							for l in range(k):
-								if comb[l] == e[0] or comb[l] == e[1] or comb[l] == e[2]:
-									got += 1
-							if got == 3:
-								num_e += 1
-								if num_e == ceiling:
-									return True
-						elif self._r == 2:
-							e = &self._edges[2 * j]
-							for l in range(k):
-								if comb[l] == e[0] or comb[l] == e[1]:
-									got += 1
-							if got == 2:
-								num_e += 1
-								if num_e == ceiling:
-									return True
-					if forbidden_edge_nums[num_e] == 1:
-						return True
-	
+
+			for i in range(nc):
+				num_e = count_edges_within(masks, self, &c[k * i], k)
+				if num_e >= ceiling or forbidden_edge_nums[num_e] == 1:
+					free(forbidden_edge_nums)
+					free(masks)
+					return True
+
+			free(forbidden_edge_nums)
+
+		free(masks)
 		return False
 
 	
 	def has_forbidden_graphs(self, graphs, must_have_highest=False, induced=False):
 	
-		cdef int *c, nc, i, j
-		cdef HypergraphFlag h, ig
+		cdef int *c, nc, i, j, num_e, *copies
+		cdef uint64_t *masks
+		cdef HypergraphFlag h
 		
 		if self.is_degenerate:
 			raise NotImplementedError("degenerate graphs are not supported.")
 		
+		masks = make_adjacency_masks(self)
+
 		for i in range(len(graphs)):
 	
 			h = <HypergraphFlag ?> graphs[i]
@@ -1236,19 +1169,26 @@ cdef class HypergraphFlag (Flag):
 			else:
 				c = generate_combinations(self._n, h._n, &nc)
 	
+			copies = edge_copies(h)
+
 			for j in range(nc):
 			
-				ig = self.c_induced_subgraph(&c[j * h._n], h._n)
+				num_e = count_edges_within(masks, self, &c[j * h._n], h._n)
 			
-				if ig.ne < h.ne:
+				if num_e < h.ne:
 					continue
 					
-				if induced and ig.ne > h.ne:
+				if induced and num_e > h.ne:
 					continue
 				
-				if ig.c_has_subgraph(h):
+				if contains_subgraph(masks, self, h, copies, &c[j * h._n], h._n):
+					free(copies)
+					free(masks)
 					return True
+
+			free(copies)
 	
+		free(masks)
 		return False
 
 
@@ -1438,164 +1378,199 @@ cdef class HypergraphFlag (Flag):
 		return [Integer(count[i]) / total for i in range(len(flags))]
 
 
-	#
-	# TODO: Make this function accept more than one type on s vertices.
-	#
-	
 	@classmethod
-	def flag_products (cls, graph_block gb, HypergraphFlag tg, graph_block flags1, graph_block flags2):
-	
-		cdef int *p, np, *pp, *pf1, *pf2, *edges, *cur_edges
-		cdef int n, s, m1, m2, ne, i, j, k, gi
-		cdef int cnte, cnf1e, cnf2e
-		cdef int has_type, has_f1
-		cdef int f1index, f2index, *grb, equal_flags_mode, nzcount, row
-		cdef HypergraphFlag g, t, f1, f2
-		
-		rarray = numpy.zeros([0, 5], dtype=numpy.int)
-		row = 0
-		
-		#sig_on()
+	def flag_products (cls, graph_block gb, HypergraphFlag tg, graph_block flags1, graph_block flags2, threads=None, orbits=False):
+		"""
+		Returns a pair (rarray, denominator), where rarray is an int32 array with a row
+		(gi, i, j, count) for each graph gi of gb and pair of flags i of flags1 and j of
+		flags2 (i <= j if flags2 is None) whose product has a nonzero coefficient
+		count / denominator in the graph.
 		
-		n = gb.n
-		s = tg.n
-		m1 = flags1.n
+		If threads is an integer greater than 1, the graphs are shared out between that
+		many threads. The work is done without the GIL, and the rows come out in the same
+		order.
+
+		If orbits is True, the automorphisms of each graph are found first, and only one
+		type embedding in each orbit of the automorphism group is looked at. Its counts are
+		multiplied by the size of the orbit. This is quicker for graphs with many
+		automorphisms, and gives the same result.
+
+		EXAMPLES:
+
+		The products are the same with one thread or several, and with or without orbits
+		(the flag cache is turned off, so that nothing else is printed):
+
+		sage: import flagmatic.hypergraph_flag as hypergraph_flag
+		sage: cache_directory = hypergraph_flag.flag_cache_directory
+		sage: hypergraph_flag.flag_cache_directory = None
+		sage: for cls, n, tg, m in [(GraphFlag, 6, GraphFlag("2:12"), 4), (ThreeGraphFlag, 6, ThreeGraphFlag("2:"), 4)]:
+		....:     gb = make_graph_block(cls.generate_graphs(n), n)
+		....:     fb = make_graph_block(cls.generate_flags(m, tg), m)
+		....:     rarray, denominator = cls.flag_products(gb, tg, fb, None)
+		....:     for threads, orbits in [(4, False), (1, True), (4, True)]:
+		....:         other, other_denominator = cls.flag_products(gb, tg, fb, None, threads=threads, orbits=orbits)
+		....:         print other_denominator == denominator, other.tolist() == rarray.tolist()
+		True True
+		True True
+		True True
+		True True
+		True True
+		True True
+		sage: hypergraph_flag.flag_cache_directory = cache_directory
+		"""
+		return cls.multiple_flag_products(gb, [tg], [flags1], None if flags2 is None else [flags2], threads=threads,
+			orbits=orbits)[0]
+
+
+	@classmethod
+	def multiple_flag_products (cls, graph_block gb, types, flags1, flags2=None, threads=None, orbits=False):
+		"""
+		Like flag_products, but for a list of types, which must all have the same order,
+		with lists of flag blocks to match (all blocks in flags1 must have the same order,
+		and likewise for flags2). Returns a list of (rarray, denominator) pairs, one for
+		each type. The graphs are only gone through once, rather than once for each type.
+		"""
+	
+		cdef int k, row, gi, num, capacity, *auts
+		cdef products_job job
+		cdef products_task task
+		cdef products_chunk *chunk
+		cdef HypergraphFlag tg, g
+		cdef graph_block types_block
+		cdef numpy.ndarray[numpy.int32_t, ndim=2] rarray
+
+		if len(types) == 0:
+			return []
+
+		if len(set(tg.n for tg in types)) != 1:
+			raise ValueError("types must all have the same order.")
+
+		if len(set((<graph_block> fb).n for fb in flags1)) != 1:
+			raise ValueError("flags must all have the same order.")
+
+		if not flags2 is None and len(set((<graph_block> fb).n for fb in flags2)) != 1:
+			raise ValueError("flags must all have the same order.")
+
+		# The type is compared with induced subgraphs, which are unlabelled.
+		active = [i for i in range(len(types)) if (<HypergraphFlag> types[i])._t == 0]
+		types_block = make_graph_block([types[i] for i in active], types[0].n)
+		for k in range(len(active)):
+			if types_block.index_of(types[active[k]]) != k:
+				# The same type appears twice, so do them one at a time.
+				return [cls.multiple_flag_products(gb, [types[i]], [flags1[i]], None if flags2 is None else [flags2[i]],
+					threads=threads, orbits=orbits)[0] for i in range(len(types))]
+
+		tg = types[0]
+		job.n = gb.n
+		job.s = tg.n
+		job.r = tg._r
+		job.oriented = tg._oriented
+		job.m1 = (<graph_block> flags1[0]).n
 	
 		if not flags2 is None:
 	
-			equal_flags_mode = 0
-			m2 = flags2.n
-			p = generate_pair_combinations(n, s, m1, m2, &np)
+			job.equal_flags_mode = 0
+			job.m2 = (<graph_block> flags2[0]).n
+			job.p = generate_pair_combinations(job.n, job.s, job.m1, job.m2, &job.np)
 	
 		else:
 	
-			equal_flags_mode = 1
-			m2 = flags1.n
+			job.equal_flags_mode = 1
+			job.m2 = job.m1
 			flags2 = flags1
-			p = generate_equal_pair_combinations(n, s, m1, &np)
-	
-		cur_edges = <int *> malloc (sizeof(int) * MAX_NUMBER_OF_EDGE_INTS)
-		pf1 = <int *> malloc (sizeof(int) * m1)
-		pf2 = <int *> malloc (sizeof(int) * m2)
-		grb = <int *> malloc (flags1.len * flags2.len * sizeof(int))
-	
-		for gi in range(gb.len):
-	
-			#sig_on()
-		
-			g = <HypergraphFlag> gb.graphs[gi]
-		
-			memset(grb, 0, flags1.len * flags2.len * sizeof(int))
-		
-			ne = g.ne
-			edges = g._edges
-	
-			has_type = 0
-			has_f1 = 0
-	
-			for i in range(np):
-			
-				pp = &p[(i * n)]
-			
-				if pp[0] != 0:
-			
-					for j in range(s):
-						pf1[j] = pp[j]
-						pf2[j] = pp[j]
-							
-					has_type = 0
-					t = g.c_induced_subgraph(pf1, s)
-					if tg.is_labelled_isomorphic(t):
-						has_type = 1
-		
-				if has_type == 0:
-					continue
-				
-				if has_type and pp[s] != 0:
-		
-					has_f1 = 0
-		
-					for j in range(m1 - s):
-						pf1[s + j] = pp[s + j]
-		
-					f1 = g.c_induced_subgraph(pf1, m1)
-					f1.t = s
-					f1.make_minimal_isomorph()
-	
-					for j in range(flags1.len):
-						if f1.is_labelled_isomorphic(<HypergraphFlag> flags1.graphs[j]):
-							has_f1 = 1
-							f1index = j
-							break
-		
-				if has_f1 == 0:
-					continue
-		
-				for j in range(m2 - s):
-					pf2[s + j] = pp[m1 + j]
-		
-				f2 = g.c_induced_subgraph(pf2, m2)
-				f2.t = s
-				f2.make_minimal_isomorph()
-				
-				for j in range(flags2.len):
-					if f2.is_labelled_isomorphic(<HypergraphFlag> flags2.graphs[j]):
-						f2index = j
-						grb[(f1index * flags1.len) + f2index] += 1
-						break
-	
-			if equal_flags_mode:
-		
-				nzcount = 0
-				for i in range(flags1.len):
-					for j in range(i, flags1.len):
-						k = grb[(i * flags1.len) + j] + grb[(j * flags1.len) + i]
-						if k != 0:
-							nzcount += 1
-	
-				rarray.resize([row + nzcount, 5], refcheck=False)
-				
-				for i in range(flags1.len):
-					for j in range(i, flags1.len):
-						k = grb[(i * flags1.len) + j] + grb[(j * flags1.len) + i]
-						if k != 0:
-							rarray[row, 0] = gi
-							rarray[row, 1] = i
-							rarray[row, 2] = j
-							rarray[row, 3] = k
-							rarray[row, 4] = np * 2
-							row += 1
-	
+			job.p = generate_equal_pair_combinations(job.n, job.s, job.m1, &job.np)
+
+		# The pair combinations come in runs of the same length, one for each s-tuple.
+		job.num_tuples = falling_factorial(job.n, job.s)
+		job.tuple_len = job.np / job.num_tuples
+
+		# Everything that is allocated below is freed at the end, even if something fails.
+		job.subsets1 = NULL
+		job.subsets2 = NULL
+		job.pairs = NULL
+		job.tuple_steps = NULL
+		job.automorphisms = NULL
+		job.aut_offsets = NULL
+		job.flags1 = NULL
+		job.flags2 = NULL
+
+		try:
+			make_subset_tables(&job)
+
+			if orbits and check_tuple_indices(&job):
+				# Most graphs have only a few automorphisms, so the buffer is grown as needed.
+				capacity = gb.len + MAX_NUMBER_OF_AUTOMORPHISMS
+				job.aut_offsets = <int *> malloc((gb.len + 1) * sizeof(int))
+				job.automorphisms = <int *> malloc(capacity * (job.n + 1) * sizeof(int))
+				if job.aut_offsets == NULL or job.automorphisms == NULL:
+					raise MemoryError
+				num = 0
+				for gi in range(gb.len):
+					if num + MAX_NUMBER_OF_AUTOMORPHISMS > capacity:
+						capacity = 2 * capacity
+						auts = <int *> realloc(job.automorphisms, capacity * (job.n + 1) * sizeof(int))
+						if auts == NULL:
+							raise MemoryError
+						job.automorphisms = auts
+					g = <HypergraphFlag> gb.graphs[gi]
+					job.aut_offsets[gi] = num
+					num += raw_automorphisms(g._edges, g.ne, g._n, g._r, g._oriented, &job.automorphisms[num * (job.n + 1)])
+				job.aut_offsets[gb.len] = num
+
+			job.num_types = len(active)
+			job.graphs = gb.pack()
+			job.types = types_block.pack()
+			job.flags1 = <packed_flags **> malloc((len(active) + 1) * sizeof(packed_flags *))
+			job.flags2 = <packed_flags **> malloc((len(active) + 1) * sizeof(packed_flags *))
+			for k in range(len(active)):
+				job.flags1[k] = (<graph_block> flags1[active[k]]).pack()
+				job.flags2[k] = (<graph_block> flags2[active[k]]).pack()
+
+			if threads is None or threads < 1:
+				threads = 1
+			tasks = []
+			for i in range(threads):
+				task = products_task()
+				task.job = &job
+				task.start = gb.len * i / threads
+				task.end = gb.len * (i + 1) / threads
+				tasks.append(task)
+
+			if threads == 1:
+				tasks[0].run()
 			else:
-		
-				nzcount = 0
-				for i in range(flags1.len):
-					for j in range(flags2.len):
-						k = grb[(i * flags1.len) + j]
-						if k != 0:
-							nzcount += 1
-	
-				rarray.resize([row + nzcount, 5], refcheck=False)
-				
-				for i in range(flags1.len):
-					for j in range(flags2.len):
-						k = grb[(i * flags1.len) + j]
-						if k != 0:
-							rarray[row, 0] = gi
-							rarray[row, 1] = i
-							rarray[row, 2] = j
-							rarray[row, 3] = k
-							rarray[row, 4] = np
-							row += 1
-	
-		free(cur_edges)
-		free(pf1)
-		free(pf2)
-		free(grb)
-	
-		#sig_off()
-		
-		return rarray
+				workers = [threading.Thread(target=task.run) for task in tasks]
+				for worker in workers:
+					worker.start()
+				for worker in workers:
+					worker.join()
+		finally:
+			free(job.flags1)
+			free(job.flags2)
+			free(job.subsets1)
+			free(job.subsets2)
+			free(job.pairs)
+			free(job.tuple_steps)
+			free(job.automorphisms)
+			free(job.aut_offsets)
+
+		# The denominator counts ordered pairs in equal flags mode.
+		denominator = job.np * 2 if job.equal_flags_mode else job.np
+		rarrays = [(numpy.zeros([0, 4], dtype=numpy.int32), denominator) for i in range(len(types))]
+
+		# The chunks are copied into the array in order, which keeps the rows sorted.
+		for k in range(len(active)):
+			rarray = numpy.empty([sum((<products_task> task).outs[k].len for task in tasks), 4], dtype=numpy.int32)
+			row = 0
+			for task in tasks:
+				chunk = task.outs[k].first
+				while chunk != NULL:
+					memcpy(rarray.data + row * 4 * sizeof(int), chunk.rows, chunk.len * 4 * sizeof(int))
+					row += chunk.len
+					chunk = chunk.next
+			rarrays[active[k]] = (rarray, denominator)
+		
+		return rarrays
 
 
 #
@@ -1603,7 +1578,176 @@ cdef class HypergraphFlag (Flag):
 #
 
 
-cdef void raw_minimize_edges(int *edges, int m, int r, bint oriented):
+#
+# Vertex sets are held as bit masks, with bit v for vertex v (vertices are numbered from
+# 1, and there are at most 35 of them). The adjacency masks of a flag are: for 2-graphs,
+# bit w of masks[l * (n + 1) + v] is set if there are more than l edges from v to w; for
+# 3-graphs, bit c of masks[(l * (n + 1) + a) * (n + 1) + b] is set if there are more than
+# l edges {a, b, c}.
+#
+
+cdef inline uint64_t vertex_mask(int *e, int r) nogil:
+
+	cdef int i
+	cdef uint64_t mask = 0
+
+	for i in range(r):
+		mask |= (<uint64_t> 1) << e[i]
+	return mask
+
+
+cdef inline bint same_edge(int *e1, int *e2, int r, bint oriented):
+
+	cdef int i
+
+	if oriented:
+		for i in range(r):
+			if e1[i] != e2[i]:
+				return False
+		return True
+
+	return vertex_mask(e1, r) == vertex_mask(e2, r)
+
+
+cdef int raw_induced_edges(int *edges, int ne, int r, int *verts, int k, int *induced) nogil:
+	"""
+	Puts in induced the edges inside the vertices verts[0], ..., verts[k - 1], relabelled
+	1, ..., k. Returns the number of edges.
+	"""
+	cdef int i, j, nm = 0, *e, pos[MAX_NUMBER_OF_VERTICES + 1]
+	cdef uint64_t vmask = 0
+
+	# An edge is kept if its vertex mask lies within vmask.
+	for j in range(k):
+		vmask |= (<uint64_t> 1) << verts[j]
+		pos[verts[j]] = j + 1
+
+	for i in range(ne):
+		e = &edges[r * i]
+		if vertex_mask(e, r) & ~vmask:
+			continue
+		for j in range(r):
+			induced[r * nm + j] = pos[e[j]]
+		nm += 1
+
+	return nm
+
+
+cdef uint64_t *make_adjacency_masks(HypergraphFlag g):
+	"""
+	Returns the adjacency masks of g. They should be freed by the caller.
+	"""
+	cdef int i, j, l, a, b, c, n1 = g._n + 1, *e
+	cdef uint64_t *masks
+
+	if g._r == 3:
+		masks = <uint64_t *> calloc(g._multiplicity * n1 * n1, sizeof(uint64_t))
+	else:
+		masks = <uint64_t *> calloc(g._multiplicity * n1, sizeof(uint64_t))
+
+	for i in range(g.ne):
+		e = &g._edges[g._r * i]
+		if g._r == 3:
+			for j in range(3):
+				a = e[j]
+				b = e[(j + 1) % 3]
+				c = e[(j + 2) % 3]
+				for l in range(g._multiplicity):
+					if not (masks[(l * n1 + a) * n1 + b] >> c) & 1:
+						masks[(l * n1 + a) * n1 + b] |= (<uint64_t> 1) << c
+						masks[(l * n1 + b) * n1 + a] |= (<uint64_t> 1) << c
+						break
+		else:
+			a = e[0]
+			b = e[1]
+			for l in range(g._multiplicity):
+				if not (masks[l * n1 + a] >> b) & 1:
+					masks[l * n1 + a] |= (<uint64_t> 1) << b
+					if not g._oriented:
+						masks[l * n1 + b] |= (<uint64_t> 1) << a
+					break
+
+	return masks
+
+
+cdef int count_edges_within(uint64_t *masks, HypergraphFlag g, int *verts, int k):
+	"""
+	Returns the number of edges of g inside the set verts of size k, given the
+	adjacency masks of g.
+	"""
+	cdef int i, j, l, total = 0, n1 = g._n + 1
+	cdef uint64_t vmask = 0
+
+	for i in range(k):
+		vmask |= (<uint64_t> 1) << verts[i]
+
+	for l in range(g._multiplicity):
+		for i in range(k):
+			if g._r == 3:
+				for j in range(i + 1, k):
+					total += __builtin_popcountll(masks[(l * n1 + verts[i]) * n1 + verts[j]] & vmask)
+			else:
+				total += __builtin_popcountll(masks[l * n1 + verts[i]] & vmask)
+
+	# Each edge has been counted once for each pair (3-graphs) or each end (2-graphs).
+	if g._r == 3:
+		return total / 3
+	if not g._oriented:
+		return total / 2
+	return total
+
+
+cdef int *edge_copies(HypergraphFlag h):
+	"""
+	Returns an array (to be freed by the caller) whose jth entry is the number of earlier
+	edges of h that are the same as edge j. Edge j has to be found in that layer of the
+	adjacency masks.
+	"""
+	cdef int j, k, *copies = <int *> calloc(h.ne + 1, sizeof(int))
+
+	for j in range(h.ne):
+		for k in range(j):
+			if same_edge(&h._edges[h._r * j], &h._edges[h._r * k], h._r, h._oriented):
+				copies[j] += 1
+	return copies
+
+
+cdef bint contains_subgraph(uint64_t *masks, HypergraphFlag g, HypergraphFlag h, int *copies, int *verts, int k):
+	"""
+	Determines if h can be mapped into the vertices verts[0], ..., verts[k - 1] of g so that
+	every edge of h goes to an edge of g. masks are the adjacency masks of g, and copies
+	comes from edge_copies(h).
+	"""
+	cdef int i, j, l, *p, *he, np, a, b, c, n1 = g._n + 1
+
+	if h._n > k:
+		return False
+
+	for j in range(h.ne):
+		if copies[j] >= g._multiplicity:
+			return False
+
+	p = generate_permutations(k, &np)
+
+	for i in range(np):
+		for j in range(h.ne):
+			he = &h._edges[h._r * j]
+			l = copies[j]
+			a = verts[p[k * i + he[0] - 1] - 1]
+			b = verts[p[k * i + he[1] - 1] - 1]
+			if h._r == 3:
+				c = verts[p[k * i + he[2] - 1] - 1]
+				if not (masks[(l * n1 + a) * n1 + b] >> c) & 1:
+					break
+			elif not (masks[l * n1 + a] >> b) & 1:
+				break
+		else:
+			return True
+
+	return False
+
+
+cdef void raw_minimize_edges(int *edges, int m, int r, bint oriented) nogil:
 
 	cdef int i, *e, round, swapped
 	
@@ -1678,10 +1822,832 @@ cdef void raw_minimize_edges(int *edges, int m, int r, bint oriented):
 				
 			if swapped == 0:
 				break
-				
+
 			round += 1
 
 
+#
+# Canonical labelling.
+#
+# The minimal isomorph is found by a depth-first search that gives the labels t + 1,
+# t + 2, ... to the unlabelled vertices one at a time. At a node of the search, the
+# edges are sorted on their partially known labels (unknown labels sort last). The
+# first unknown label in this sorted edge list must become the next label in the
+# minimal isomorph, so only the vertices that can fill it are tried (individualization
+# and refinement). Nodes whose known prefix is already worse than the best edge list
+# found so far are abandoned, and two labellings giving the same edge list give an
+# automorphism, which is used to skip vertices in the same orbit. The amount of work
+# therefore depends on the automorphism group rather than on (n - t)!.
+#
+
+DEF UNKNOWN_LABEL = 63
+DEF MAX_NUMBER_OF_AUTOMORPHISMS = 64
+
+cdef struct isomorph_search:
+	int n, t, r, ne
+	bint oriented
+	int *edges			# original edges
+	int *labels			# labels[v] is the new label of vertex v, or 0
+	int *vertices		# vertices[l] is the vertex with new label l
+	int *keys			# work space, one key per edge per level
+	int *order			# work space, one edge ordering per level
+	int *best			# best edge list so far
+	int *best_vertices	# vertices[] for the best edge list
+	bint have_best
+	int num_automorphisms
+	int *automorphisms	# automorphisms found so far
+	int *orbits			# work space for orbit computation
+
+
+cdef inline int edge_key(isomorph_search *st, int i) nogil:
+
+	cdef int a, b, c, x, *e
+
+	e = &st.edges[i * st.r]
+
+	if st.r == 2:
+		a = st.labels[e[0]]
+		b = st.labels[e[1]]
+		if a == 0:
+			a = UNKNOWN_LABEL
+		if b == 0:
+			b = UNKNOWN_LABEL
+		if not st.oriented and a > b:
+			a, b = b, a
+		return (a << 6) | b
+
+	a = st.labels[e[0]]
+	b = st.labels[e[1]]
+	c = st.labels[e[2]]
+	if a == 0:
+		a = UNKNOWN_LABEL
+	if b == 0:
+		b = UNKNOWN_LABEL
+	if c == 0:
+		c = UNKNOWN_LABEL
+	if a > b:
+		a, b = b, a
+	if b > c:
+		b, c = c, b
+	if a > b:
+		a, b = b, a
+	return (a << 12) | (b << 6) | c
+
+
+cdef inline int key_coordinate(int key, int j, int r) nogil:
+	return (key >> (6 * (r - 1 - j))) & 63
+
+
+cdef int orbit_root(int *orbits, int v) nogil:
+	while orbits[v] != v:
+		v = orbits[v]
+	return v
+
+
+cdef void compute_orbits(isomorph_search *st, int k) nogil:
+	"""
+	Puts in st.orbits the orbits (as a union-find forest) of the group generated by the
+	known automorphisms that fix the vertices with labels 1, ..., k.
+	"""
+	cdef int i, v, x, y, *aut, fixes
+
+	for v in range(1, st.n + 1):
+		st.orbits[v] = v
+
+	for i in range(st.num_automorphisms):
+		aut = &st.automorphisms[i * (st.n + 1)]
+		fixes = 1
+		for v in range(1, k + 1):
+			if aut[st.vertices[v]] != st.vertices[v]:
+				fixes = 0
+				break
+		if not fixes:
+			continue
+		for v in range(1, st.n + 1):
+			x = orbit_root(st.orbits, v)
+			y = orbit_root(st.orbits, aut[v])
+			if x < y:
+				st.orbits[y] = x
+			elif y < x:
+				st.orbits[x] = y
+
+
+cdef void record_leaf(isomorph_search *st, int *keys, int *order) nogil:
+
+	cdef int i, j, v, cmp, *aut
+
+	cmp = -1
+	if st.have_best:
+		cmp = 0
+		for i in range(st.ne):
+			for j in range(st.r):
+				v = key_coordinate(keys[order[i]], j, st.r)
+				if v != st.best[i * st.r + j]:
+					cmp = -1 if v < st.best[i * st.r + j] else 1
+					break
+			if cmp != 0:
+				break
+
+	if cmp < 0:
+		for i in range(st.ne):
+			for j in range(st.r):
+				st.best[i * st.r + j] = key_coordinate(keys[order[i]], j, st.r)
+		for v in range(1, st.n + 1):
+			st.best_vertices[v] = st.vertices[v]
+		st.have_best = True
+
+	elif cmp == 0 and st.num_automorphisms < MAX_NUMBER_OF_AUTOMORPHISMS:
+		aut = &st.automorphisms[st.num_automorphisms * (st.n + 1)]
+		for v in range(1, st.n + 1):
+			aut[st.vertices[v]] = st.best_vertices[v]
+		st.num_automorphisms += 1
+
+
+cdef void search_minimal_isomorph(isomorph_search *st, int k) nogil:
+
+	cdef int i, j, l, v, x, key, first_key, first_i, first_j, better, *keys, *order
+	cdef int *candidates
+
+	keys = &st.keys[k * st.ne]
+	order = &st.order[k * st.ne]
+
+	for i in range(st.ne):
+		keys[i] = edge_key(st, i)
+		order[i] = i
+
+	# insertion sort of the edges by key (there are at most 85 edges)
+	for i in range(1, st.ne):
+		x = order[i]
+		j = i - 1
+		while j >= 0 and keys[order[j]] > keys[x]:
+			order[j + 1] = order[j]
+			j -= 1
+		order[j + 1] = x
+
+	# Find the first unknown label, comparing the known prefix against the best so far.
+	better = not st.have_best
+	first_i = -1
+	first_j = -1
+	for i in range(st.ne):
+		for j in range(st.r):
+			v = key_coordinate(keys[order[i]], j, st.r)
+			if v == UNKNOWN_LABEL:
+				first_i = i
+				first_j = j
+				break
+			if not better:
+				if v > st.best[i * st.r + j]:
+					return
+				if v < st.best[i * st.r + j]:
+					better = True
+		if first_i != -1:
+			break
+
+	if first_i == -1:
+		# All the edges are known, so the remaining vertices are isolated.
+		l = k
+		for v in range(1, st.n + 1):
+			if st.labels[v] == 0:
+				l += 1
+				st.labels[v] = l
+				st.vertices[l] = v
+		record_leaf(st, keys, order)
+		for v in range(1, st.n + 1):
+			if st.labels[v] > k:
+				st.labels[v] = 0
+		return
+
+	# The unknown label will be at least k + 1.
+	if not better and st.best[first_i * st.r + first_j] <= k:
+		return
+
+	# The candidates for label k + 1 are the vertices that can fill the first unknown label.
+	candidates = <int *> calloc(st.n + 1, sizeof(int))
+	first_key = keys[order[first_i]] >> (6 * (st.r - 1 - first_j))
+
+	for i in range(first_i, st.ne):
+		key = keys[order[i]]
+		if (key >> (6 * (st.r - 1 - first_j))) != first_key:
+			break
+		for j in range(st.r):
+			if st.oriented and j != first_j:
+				continue
+			v = st.edges[order[i] * st.r + j]
+			if st.labels[v] == 0:
+				candidates[v] = 1
+
+	for v in range(1, st.n + 1):
+
+		if not candidates[v]:
+			continue
+
+		# skip vertices in the same orbit as a vertex that has already been tried
+		compute_orbits(st, k)
+		x = orbit_root(st.orbits, v)
+		for l in range(1, v):
+			if candidates[l] == 2 and orbit_root(st.orbits, l) == x:
+				break
+		else:
+			candidates[v] = 2
+			st.labels[v] = k + 1
+			st.vertices[k + 1] = v
+			search_minimal_isomorph(st, k + 1)
+			st.labels[v] = 0
+
+	free(candidates)
+
+
+cdef void raw_make_minimal_isomorph(int *edges, int ne, int n, int t, int r, bint oriented) nogil:
+
+	cdef int v
+	cdef isomorph_search st
+
+	if ne == 0:
+		return
+
+	if t >= n - 1:
+		raw_minimize_edges(edges, ne, r, oriented)
+		return
+
+	st.n = n
+	st.t = t
+	st.r = r
+	st.ne = ne
+	st.oriented = oriented
+	st.edges = edges
+	st.labels = <int *> calloc(n + 1, sizeof(int))
+	st.vertices = <int *> calloc(n + 1, sizeof(int))
+	st.keys = <int *> malloc((n + 1) * ne * sizeof(int))
+	st.order = <int *> malloc((n + 1) * ne * sizeof(int))
+	st.best = <int *> malloc(r * ne * sizeof(int))
+	st.best_vertices = <int *> malloc((n + 1) * sizeof(int))
+	st.have_best = False
+	st.num_automorphisms = 0
+	st.automorphisms = <int *> malloc(MAX_NUMBER_OF_AUTOMORPHISMS * (n + 1) * sizeof(int))
+	st.orbits = <int *> malloc((n + 1) * sizeof(int))
+
+	for v in range(1, t + 1):
+		st.labels[v] = v
+		st.vertices[v] = v
+
+	search_minimal_isomorph(&st, t)
+
+	for v in range(r * ne):
+		edges[v] = st.best[v]
+
+	free(st.labels)
+	free(st.vertices)
+	free(st.keys)
+	free(st.order)
+	free(st.best)
+	free(st.best_vertices)
+	free(st.automorphisms)
+	free(st.orbits)
+
+
+#
+# The canonical form is found by individualization and refinement. The vertices are
+# kept in an ordered partition (cells), with the labelled vertices in singleton cells of
+# their own. The partition is refined until it is equitable: every vertex in a cell has
+# the same numbers of edges going to each cell (for 2-graphs) or to each pair of cells
+# (for 3-graphs). If some cell still has more than one vertex, each of its vertices is
+# individualized in turn, and the search continues. The discrete partitions at the
+# leaves give labellings, and the one with the smallest edge list is the canonical
+# form. Labellings with equal edge lists give automorphisms, which are used to skip
+# vertices in the same orbit.
+#
+# The canonical form is not the minimal isomorph, but two flags are isomorphic if and
+# only if their canonical forms are equal. It is much cheaper to compute for flags with
+# many vertices.
+#
+
+cdef struct canonical_search:
+	int n, t, r, ne, siglen
+	bint oriented
+	int *edges			# original edges
+	int *lab			# lab[level * n + i] is the vertex in position i
+	int *cell			# cell[level * (n + 1) + v] is the first position of the cell of v
+	int *sig			# signature of each vertex, relative to the cells
+	int *fixed			# fixed[level] is the vertex individualized at that level
+	int *new_edges		# edge list of a leaf
+	int *best			# smallest edge list found so far
+	int *best_lab		# lab[] for the best edge list
+	bint have_best
+	int num_automorphisms
+	int *automorphisms
+	int *orbits
+
+
+cdef inline int compare_signatures(canonical_search *st, int x, int y):
+
+	cdef int i, *sx = &st.sig[x * st.siglen], *sy = &st.sig[y * st.siglen]
+
+	for i in range(st.siglen):
+		if sx[i] != sy[i]:
+			return -1 if sx[i] < sy[i] else 1
+	return 0
+
+
+cdef void refine_partition(canonical_search *st, int *lab, int *cell):
+
+	cdef int i, j, k, x, a, b, c, start, changed, *e
+	cdef int n = st.n
+
+	while True:
+
+		memset(st.sig, 0, (n + 1) * st.siglen * sizeof(int))
+
+		for i in range(st.ne):
+			e = &st.edges[i * st.r]
+			if st.r == 2:
+				if st.oriented:
+					st.sig[e[0] * st.siglen + cell[e[1]]] += 1
+					st.sig[e[1] * st.siglen + n + cell[e[0]]] += 1
+				else:
+					st.sig[e[0] * st.siglen + cell[e[1]]] += 1
+					st.sig[e[1] * st.siglen + cell[e[0]]] += 1
+			else:
+				for j in range(3):
+					a = cell[e[(j + 1) % 3]]
+					b = cell[e[(j + 2) % 3]]
+					if a > b:
+						a, b = b, a
+					st.sig[e[j] * st.siglen + a * n + b] += 1
+
+		changed = 0
+		i = 0
+		while i < n:
+			c = cell[lab[i]]
+			j = i + 1
+			while j < n and cell[lab[j]] == c:
+				j += 1
+			if j - i > 1:
+				# insertion sort of the cell by signature
+				for k in range(i + 1, j):
+					x = lab[k]
+					a = k - 1
+					while a >= i and compare_signatures(st, lab[a], x) > 0:
+						lab[a + 1] = lab[a]
+						a -= 1
+					lab[a + 1] = x
+				start = i
+				for k in range(i + 1, j):
+					if compare_signatures(st, lab[k - 1], lab[k]) != 0:
+						start = k
+						changed = 1
+					cell[lab[k]] = start
+			i = j
+
+		if not changed:
+			break
+
+
+cdef void canonical_orbits(canonical_search *st, int level):
+
+	cdef int i, v, x, y, *aut, fixes
+
+	for v in range(1, st.n + 1):
+		st.orbits[v] = v
+
+	for i in range(st.num_automorphisms):
+		aut = &st.automorphisms[i * (st.n + 1)]
+		fixes = 1
+		for v in range(level):
+			if aut[st.fixed[v]] != st.fixed[v]:
+				fixes = 0
+				break
+		if not fixes:
+			continue
+		for v in range(1, st.n + 1):
+			x = orbit_root(st.orbits, v)
+			y = orbit_root(st.orbits, aut[v])
+			if x < y:
+				st.orbits[y] = x
+			elif y < x:
+				st.orbits[x] = y
+
+
+cdef void canonical_leaf(canonical_search *st, int *lab, int *cell):
+
+	cdef int i, cmp, *aut
+	cdef int n = st.n
+
+	# cell[] is not needed any more, so use it for the new labels
+	for i in range(n):
+		cell[lab[i]] = i + 1
+	for i in range(st.r * st.ne):
+		st.new_edges[i] = cell[st.edges[i]]
+	raw_minimize_edges(st.new_edges, st.ne, st.r, st.oriented)
+
+	cmp = -1
+	if st.have_best:
+		cmp = 0
+		for i in range(st.r * st.ne):
+			if st.new_edges[i] != st.best[i]:
+				cmp = -1 if st.new_edges[i] < st.best[i] else 1
+				break
+
+	if cmp < 0:
+		for i in range(st.r * st.ne):
+			st.best[i] = st.new_edges[i]
+		for i in range(n):
+			st.best_lab[i] = lab[i]
+		st.have_best = True
+
+	elif cmp == 0 and st.num_automorphisms < MAX_NUMBER_OF_AUTOMORPHISMS:
+		aut = &st.automorphisms[st.num_automorphisms * (n + 1)]
+		for i in range(n):
+			aut[lab[i]] = st.best_lab[i]
+		st.num_automorphisms += 1
+
+
+cdef void search_canonical_isomorph(canonical_search *st, int level):
+
+	cdef int i, j, k, v, x, c, target, size, *lab, *cell, *next_lab, *next_cell, *tried
+	cdef int n = st.n
+
+	lab = &st.lab[level * n]
+	cell = &st.cell[level * (n + 1)]
+
+	refine_partition(st, lab, cell)
+
+	target = -1
+	for i in range(n - 1):
+		if cell[lab[i]] == cell[lab[i + 1]]:
+			target = i
+			break
+
+	if target == -1:
+		canonical_leaf(st, lab, cell)
+		return
+
+	size = 1
+	while target + size < n and cell[lab[target + size]] == target:
+		size += 1
+
+	next_lab = &st.lab[(level + 1) * n]
+	next_cell = &st.cell[(level + 1) * (n + 1)]
+	tried = <int *> malloc(size * sizeof(int))
+
+	for i in range(size):
+
+		v = lab[target + i]
+
+		# skip vertices in the same orbit as a vertex that has already been tried
+		canonical_orbits(st, level)
+		x = orbit_root(st.orbits, v)
+		for j in range(i):
+			if orbit_root(st.orbits, tried[j]) == x:
+				break
+		else:
+			for j in range(n):
+				next_lab[j] = lab[j]
+			for j in range(n + 1):
+				next_cell[j] = cell[j]
+			# individualize v: it goes to the front of its cell
+			for j in range(target, target + size):
+				if next_lab[j] == v:
+					next_lab[j] = next_lab[target]
+					next_lab[target] = v
+				next_cell[next_lab[j]] = target + 1
+			next_cell[v] = target
+			st.fixed[level] = v
+			search_canonical_isomorph(st, level + 1)
+
+		tried[i] = v
+
+	free(tried)
+
+
+cdef void init_canonical_search(canonical_search *st, int *edges, int ne, int n, int t, int r, bint oriented):
+
+	cdef int i, v
+
+	st.n = n
+	st.t = t
+	st.r = r
+	st.ne = ne
+	st.oriented = oriented
+	if r == 3:
+		st.siglen = n * n
+	elif oriented:
+		st.siglen = 2 * n
+	else:
+		st.siglen = n
+	st.edges = edges
+	st.lab = <int *> malloc((n + 1) * n * sizeof(int))
+	st.cell = <int *> malloc((n + 1) * (n + 1) * sizeof(int))
+	st.sig = <int *> malloc((n + 1) * st.siglen * sizeof(int))
+	st.fixed = <int *> malloc((n + 1) * sizeof(int))
+	st.new_edges = <int *> malloc(r * ne * sizeof(int))
+	st.best = <int *> malloc(r * ne * sizeof(int))
+	st.best_lab = <int *> malloc(n * sizeof(int))
+	st.have_best = False
+	st.num_automorphisms = 0
+	st.automorphisms = <int *> malloc(MAX_NUMBER_OF_AUTOMORPHISMS * (n + 1) * sizeof(int))
+	st.orbits = <int *> malloc((n + 1) * sizeof(int))
+
+	# The labelled vertices are in singleton cells, followed by one cell for the rest.
+	for i in range(n):
+		st.lab[i] = i + 1
+	for v in range(1, n + 1):
+		st.cell[v] = v - 1 if v <= t else t
+
+
+cdef void free_canonical_search(canonical_search *st):
+
+	free(st.lab)
+	free(st.cell)
+	free(st.sig)
+	free(st.fixed)
+	free(st.new_edges)
+	free(st.best)
+	free(st.best_lab)
+	free(st.automorphisms)
+	free(st.orbits)
+
+
+cdef void raw_make_canonical_isomorph(int *edges, int ne, int n, int t, int r, bint oriented, int *positions):
+	"""
+	Relabels edges into the canonical form. If positions is not NULL, then positions[i]
+	is set to the vertex that gets label i + 1.
+	"""
+	cdef int i
+	cdef canonical_search st
+
+	if ne == 0 or t >= n - 1:
+		raw_minimize_edges(edges, ne, r, oriented)
+		if positions != NULL:
+			for i in range(n):
+				positions[i] = i + 1
+		return
+
+	init_canonical_search(&st, edges, ne, n, t, r, oriented)
+	search_canonical_isomorph(&st, 0)
+
+	for i in range(r * ne):
+		edges[i] = st.best[i]
+	if positions != NULL:
+		for i in range(n):
+			positions[i] = st.best_lab[i]
+
+	free_canonical_search(&st)
+
+
+cdef int raw_automorphisms(int *edges, int ne, int n, int r, bint oriented, int *automorphisms):
+	"""
+	Puts some automorphisms of an unlabelled flag in automorphisms, each one as n + 1
+	ints with aut[v] the image of vertex v, and returns how many there are. There are at
+	most MAX_NUMBER_OF_AUTOMORPHISMS of them. They are the automorphisms found by the
+	canonical search, which generate the whole automorphism group unless there are too
+	many of them.
+	"""
+	cdef int i, v, num
+	cdef canonical_search st
+
+	if n < 2:
+		return 0
+
+	# The search would not be done for a flag with no edges, so use (1 2) and (1 2 ... n).
+	if ne == 0:
+		for v in range(1, n + 1):
+			automorphisms[v] = v
+			automorphisms[n + 1 + v] = v % n + 1
+		automorphisms[1] = 2
+		automorphisms[2] = 1
+		return 2
+
+	init_canonical_search(&st, edges, ne, n, 0, r, oriented)
+	search_canonical_isomorph(&st, 0)
+
+	num = st.num_automorphisms
+	for i in range(num * (n + 1)):
+		automorphisms[i] = st.automorphisms[i]
+
+	free_canonical_search(&st)
+	return num
+
+
+def check_minimal_isomorphs(flags, trials=3):
+	"""
+	Checks make_minimal_isomorph against make_minimal_isomorph_by_permutations. The
+	unlabelled vertices of each flag are relabelled at random trials times, and each time
+	the minimal isomorph is found both ways, and the canonical key of the relabelled flag
+	is compared with that of the flag. The flags should be pairwise non-isomorphic (as the
+	flags returned by generate_flags are), and it is also checked that their canonical keys
+	are distinct. Raises a ValueError if any of these checks fails.
+
+	EXAMPLES:
+
+	The flag cache is turned off, so that the flags are really generated:
+
+	sage: import flagmatic.hypergraph_flag as hypergraph_flag
+	sage: cache_directory = hypergraph_flag.flag_cache_directory
+	sage: hypergraph_flag.flag_cache_directory = None
+	sage: check_minimal_isomorphs(GraphFlag.generate_flags(5, GraphFlag("2:")))
+	sage: check_minimal_isomorphs(GraphFlag.generate_flags(5, GraphFlag("3:12")))
+	sage: check_minimal_isomorphs(ThreeGraphFlag.generate_flags(5, ThreeGraphFlag("3:")))
+	sage: check_minimal_isomorphs(ThreeGraphFlag.generate_flags(5, ThreeGraphFlag("3:123")))
+	sage: check_minimal_isomorphs(OrientedGraphFlag.generate_flags(5, OrientedGraphFlag("3:1223")))
+	sage: hypergraph_flag.flag_cache_directory = cache_directory
+	"""
+	cdef int i
+	cdef HypergraphFlag g, h1, h2
+
+	keys = set()
+
+	for g in flags:
+		key = g.canonical_key()
+		if key in keys:
+			raise ValueError("%s has the same canonical key as another flag." % g)
+		keys.add(key)
+		for trial in range(trials):
+			unlabelled = range(g._t + 1, g._n + 1)
+			random.shuffle(unlabelled)
+			p = range(g._t + 1) + unlabelled
+			h1 = g.__copy__()
+			for i in range(h1._r * h1.ne):
+				h1._edges[i] = p[g._edges[i]]
+			h1._certified_minimal_isomorph = False
+			if h1.canonical_key() != key:
+				raise ValueError("canonical keys of %s and its relabelling %s differ." % (g, h1))
+			h2 = h1.__copy__()
+			h1.make_minimal_isomorph()
+			h2.make_minimal_isomorph_by_permutations()
+			if h1._repr_() != h2._repr_():
+				raise ValueError("minimal isomorphs of %s differ: %s and %s." % (g, h1, h2))
+
+
+def extend_flags(args):
+	"""
+	Returns the flags on n vertices obtained by adding a vertex to each of the flags
+	in smaller_graphs, as a list of (canonical key, flag) pairs. The flags are distinct,
+	and in the order they are found. This is a helper for generate_flags, and takes a
+	single tuple of arguments so that it can be given to a multiprocessing.Pool.
+	"""
+
+	n, s, r, oriented, multiplicity, forbidden_edge_numbers, forbidden_graphs, forbidden_induced_graphs, \
+		canonical_augmentation, smaller_graphs = args
+
+	max_ne = binomial(n - 1, r - 1) * multiplicity
+	
+	extensions = []
+	keys = set()
+
+	possible_edges = []
+
+	if r == 3:
+		for c in Combinations(range(1, n), 2):
+			possible_edges.append((c[0], c[1], n))
+
+	elif r == 2:
+		for x in range(1, n):
+			possible_edges.append((x, n))
+
+	if multiplicity > 1:
+		possible_edges = sum(([e] * multiplicity for e in possible_edges), [])
+
+	# In a tournament, the new vertex must be joined to every other vertex.
+	tournament = oriented and not forbidden_edge_numbers is None and (2, 0) in forbidden_edge_numbers
+
+	for sg in smaller_graphs:
+	
+		ds = sg.degrees()
+		maxd = max(ds[s:] + (0,))
+		
+		# Only extensions of the same flag can be isomorphic.
+		if canonical_augmentation:
+			keys = set()
+			
+		for ne in range(maxd, max_ne + 1):
+		
+			if tournament and ne != n - 1:
+				continue
+
+			if oriented:
+				neighbourhoods = oriented_neighbourhoods(n, ne, 1)
+			else:
+				neighbourhoods = Combinations(possible_edges, ne)
+
+			for nb in neighbourhoods:
+
+				ng = sg.__copy__()
+				ng.n = n
+				for e in nb:
+					ng.add_edge(e)
+
+				if canonical_augmentation and not is_canonical_extension(ng):
+					continue
+
+				if not forbidden_edge_numbers is None and ng.has_forbidden_edge_numbers(forbidden_edge_numbers, must_have_highest=True):
+					continue
+
+				if not forbidden_graphs is None and ng.has_forbidden_graphs(forbidden_graphs, must_have_highest=True):
+					continue
+
+				if not forbidden_induced_graphs is None and ng.has_forbidden_graphs(forbidden_induced_graphs, must_have_highest=True, induced=True):
+					continue
+
+				ng_key = ng.canonical_key()
+				if not ng_key in keys:
+					ng.make_minimal_isomorph()
+					extensions.append((ng_key, ng))
+					keys.add(ng_key)
+
+	return extensions
+
+
+def oriented_neighbourhoods(n, ne, start):
+	"""
+	Generates the lists of ne arcs between vertex n and vertices start, ..., n - 1, with
+	at most one arc (in either direction) for each vertex. They come out in the same
+	order as the combinations of [(1, n), (n, 1), (2, n), (n, 2), ...] would.
+	"""
+
+	if ne == 0:
+		yield []
+		return
+
+	for x in range(start, n - ne + 1):
+		for e in ((x, n), (n, x)):
+			for rest in oriented_neighbourhoods(n, ne - 1, x + 1):
+				yield [e] + rest
+
+
+#
+# Canonical augmentation (McKay, "Isomorph-free exhaustive generation"). A flag on n
+# vertices is only accepted as an extension of its parent if the new vertex n is in the
+# same orbit as the canonical deletion vertex: the unlabelled vertex of maximum degree
+# that comes last in the canonical labelling. As the parents are pairwise non-isomorphic,
+# two accepted flags can only be isomorphic if they come from the same parent.
+#
+
+cdef void individualized_canonical_form(HypergraphFlag g, int v, int *edges):
+
+	cdef int i, w, t = g._t + 1
+
+	for i in range(g._r * g.ne):
+		w = g._edges[i]
+		if w == v:
+			w = t
+		elif w == t:
+			w = v
+		edges[i] = w
+	raw_make_canonical_isomorph(edges, g.ne, g._n, t, g._r, g._oriented, NULL)
+
+
+cdef bint is_canonical_extension(HypergraphFlag g):
+
+	cdef int i, v, m, maxd, n = g._n, t = g._t, ne = g.ne, size = g._r * g.ne
+	cdef int *degrees, *positions, *edges1, *edges2
+	cdef bint result
+
+	if ne == 0 or n - t <= 1:
+		return True
+
+	degrees = <int *> calloc(n + 1, sizeof(int))
+	for i in range(size):
+		degrees[g._edges[i]] += 1
+
+	maxd = 0
+	for v in range(t + 1, n + 1):
+		if degrees[v] > maxd:
+			maxd = degrees[v]
+
+	if degrees[n] < maxd:
+		free(degrees)
+		return False
+
+	positions = <int *> malloc(n * sizeof(int))
+	edges1 = <int *> malloc(size * sizeof(int))
+	edges2 = <int *> malloc(size * sizeof(int))
+
+	for i in range(size):
+		edges1[i] = g._edges[i]
+	raw_make_canonical_isomorph(edges1, ne, n, t, g._r, g._oriented, positions)
+
+	m = n
+	for i in range(n - 1, t - 1, -1):
+		if degrees[positions[i]] == maxd:
+			m = positions[i]
+			break
+
+	result = True
+	if m != n:
+		individualized_canonical_form(g, n, edges1)
+		individualized_canonical_form(g, m, edges2)
+		for i in range(size):
+			if edges1[i] != edges2[i]:
+				result = False
+				break
+
+	free(degrees)
+	free(positions)
+	free(edges1)
+	free(edges2)
+	return result
+
+
 cdef class combinatorial_info_block:
 	pass
 
@@ -1948,8 +2914,449 @@ def get_equal_pair_combinations (n, s, m):
 	return [[p[(i * n) + j] for j in range(n)] for i in range(np)]
 
 
+#
+# The flag products are computed by products_kernel, which only uses C data, so that it
+# can run without the GIL. It handles several types of the same order at once: the type
+# induced by each s-tuple is looked up in a table of the types, and the counts go to that
+# type. The s-tuples that embed a type are found first, so that the pair combinations
+# of the other s-tuples can be skipped altogether. For each embedding, the flags on the
+# (m - s)-subsets of the other vertices are found once, and the pair combinations are
+# then counted from a table of subset pairs, which is the same for every s-tuple. If the
+# automorphisms of the graphs are given, only one s-tuple in each orbit is looked at, and
+# its counts are multiplied by the size of the orbit. Each products_task runs the kernel
+# on a range of graphs, and collects rows (gi, i, j, count) for each type in its own
+# buffers. The buffers are a list of fixed size chunks, so that rows are never moved
+# until they are copied into the result.
+#
+
+DEF PRODUCTS_CHUNK_ROWS = 4096
+
+cdef struct products_job:
+	int n, s, r, m1, m2, np, equal_flags_mode, num_types, num_tuples, tuple_len
+	int num_subsets1, num_subsets2
+	bint oriented
+	int *p
+	int *subsets1
+	int *subsets2
+	int *pairs
+	int *tuple_steps
+	int *automorphisms
+	int *aut_offsets
+	packed_flags *graphs
+	packed_flags *types
+	packed_flags **flags1
+	packed_flags **flags2
+
+
+cdef struct products_chunk:
+	int len
+	int rows[4 * PRODUCTS_CHUNK_ROWS]
+	products_chunk *next
+
+
+cdef struct products_output:
+	int len
+	products_chunk *first
+	products_chunk *last
+
+
+cdef int *products_output_row(products_output *out) nogil:
+
+	cdef products_chunk *chunk = out.last
+
+	if chunk == NULL or chunk.len == PRODUCTS_CHUNK_ROWS:
+		chunk = <products_chunk *> malloc(sizeof(products_chunk))
+		chunk.len = 0
+		chunk.next = NULL
+		if out.last == NULL:
+			out.first = chunk
+		else:
+			out.last.next = chunk
+		out.last = chunk
+
+	chunk.len += 1
+	out.len += 1
+	return &chunk.rows[4 * (chunk.len - 1)]
+
+
+cdef make_subset_tables(products_job *job):
+	"""
+	Sets up job.subsets1 and job.subsets2, which hold the (m1 - s)- and (m2 - s)-subsets
+	of range(n - s), and job.pairs, which holds, for each pair combination in the run of
+	the first s-tuple, the indices of the two subsets. A subset of range(n - s) stands for
+	the vertices at those positions among the vertices outside an s-tuple.
+	"""
+	cdef int i, j, n = job.n, s = job.s, *pp
+
+	subsets1 = list(Combinations(range(n - s), job.m1 - s))
+	subsets2 = list(Combinations(range(n - s), job.m2 - s))
+	job.num_subsets1 = len(subsets1)
+	job.num_subsets2 = len(subsets2)
+	job.subsets1 = <int *> malloc((job.num_subsets1 * (job.m1 - s) + 1) * sizeof(int))
+	job.subsets2 = <int *> malloc((job.num_subsets2 * (job.m2 - s) + 1) * sizeof(int))
+	for i in range(job.num_subsets1):
+		for j in range(job.m1 - s):
+			job.subsets1[i * (job.m1 - s) + j] = subsets1[i][j]
+	for i in range(job.num_subsets2):
+		for j in range(job.m2 - s):
+			job.subsets2[i * (job.m2 - s) + j] = subsets2[i][j]
+
+	indices1 = dict((tuple(subsets1[i]), i) for i in range(job.num_subsets1))
+	indices2 = dict((tuple(subsets2[i]), i) for i in range(job.num_subsets2))
+	first_tuple = [job.p[j] for j in range(s)]
+	positions = dict((v, i) for i, v in enumerate([v for v in range(1, n + 1) if not v in first_tuple]))
+
+	job.pairs = <int *> malloc((2 * job.tuple_len + 1) * sizeof(int))
+	for i in range(job.tuple_len):
+		pp = &job.p[i * n]
+		if pp[s] != 0:
+			comb1 = tuple(positions[pp[s + j]] for j in range(job.m1 - s))
+		comb2 = tuple(positions[pp[job.m1 + j]] for j in range(job.m2 - s))
+		job.pairs[2 * i] = indices1[comb1]
+		job.pairs[2 * i + 1] = indices2[comb2]
+
+	# The s-tuples come in lexicographic order, so tuple_index can find their positions.
+	job.tuple_steps = <int *> malloc((s + 1) * sizeof(int))
+	for i in range(s):
+		job.tuple_steps[i] = falling_factorial(n - 1 - i, s - 1 - i)
+
+
+cdef int tuple_index(products_job *job, int *tup) nogil:
+	"""
+	Returns the position of an s-tuple of vertices among all the s-tuples.
+	"""
+	cdef int i, j, c, index = 0
+
+	for i in range(job.s):
+		c = tup[i] - 1
+		for j in range(i):
+			if tup[j] < tup[i]:
+				c -= 1
+		index += c * job.tuple_steps[i]
+	return index
+
+
+cdef bint check_tuple_indices(products_job *job):
+	"""
+	Returns True if the s-tuples of the pair combinations are where tuple_index expects.
+	"""
+	cdef int b
+
+	for b in range(job.num_tuples):
+		if tuple_index(job, &job.p[b * job.tuple_len * job.n]) != b:
+			return False
+	return True
+
+
+cdef int compare_ints(const void *a, const void *b) nogil:
+	return (<int *> a)[0] - (<int *> b)[0]
+
+
+cdef void products_kernel(products_job *job, int start, int end, products_output *outs) nogil:
+
+	cdef int gi, i, j, k, ti, b, e, nm, ne, *pp, *edges, *grb, *touched, *subset, len2
+	cdef int f1index, f2index, num_embeddings, num_outside, weight, x, y, *aut
+	cdef int tup[MAX_NUMBER_OF_VERTICES]
+	cdef int n = job.n, s = job.s, r = job.r, m1 = job.m1, m2 = job.m2
+	cdef int pf[MAX_NUMBER_OF_VERTICES], outside[MAX_NUMBER_OF_VERTICES]
+	cdef int induced[MAX_NUMBER_OF_EDGE_INTS]
+	cdef int **grbs, **toucheds, *num_touched, *row, *embedding_tuples, *embedding_types
+	cdef int *embedding_weights, *tuple_orbits, *orbit_sizes
+	cdef int *indices1, *indices2
+	cdef uint64_t tuple_mask
+	cdef products_output *out
+
+	grbs = <int **> malloc(job.num_types * sizeof(int *))
+	toucheds = <int **> malloc(job.num_types * sizeof(int *))
+	num_touched = <int *> calloc(job.num_types, sizeof(int))
+	embedding_tuples = <int *> malloc(job.num_tuples * sizeof(int))
+	embedding_types = <int *> malloc(job.num_tuples * sizeof(int))
+	embedding_weights = <int *> malloc(job.num_tuples * sizeof(int))
+	tuple_orbits = <int *> malloc(job.num_tuples * sizeof(int))
+	orbit_sizes = <int *> malloc(job.num_tuples * sizeof(int))
+	indices1 = <int *> malloc((job.num_subsets1 + 1) * sizeof(int))
+	if job.equal_flags_mode:
+		indices2 = indices1
+	else:
+		indices2 = <int *> malloc((job.num_subsets2 + 1) * sizeof(int))
+	for ti in range(job.num_types):
+		grbs[ti] = <int *> calloc(job.flags1[ti].len * job.flags2[ti].len + 1, sizeof(int))
+		toucheds[ti] = <int *> malloc((job.np + 1) * sizeof(int))
+
+	for gi in range(start, end):
+
+		edges = &job.graphs.edges[job.graphs.offsets[gi]]
+		ne = job.graphs.ne[gi]
+
+		for b in range(job.num_tuples):
+			tuple_orbits[b] = b
+			orbit_sizes[b] = 1
+
+		# Find the orbits of the s-tuples, as a union-find forest with the smallest
+		# tuple of each orbit at the root.
+		if job.automorphisms != NULL:
+			for k in range(job.aut_offsets[gi], job.aut_offsets[gi + 1]):
+				aut = &job.automorphisms[k * (n + 1)]
+				for b in range(job.num_tuples):
+					pp = &job.p[b * job.tuple_len * n]
+					for j in range(s):
+						tup[j] = aut[pp[j]]
+					x = orbit_root(tuple_orbits, b)
+					y = orbit_root(tuple_orbits, tuple_index(job, tup))
+					if x < y:
+						tuple_orbits[y] = x
+					elif y < x:
+						tuple_orbits[x] = y
+			for b in range(job.num_tuples):
+				orbit_sizes[b] = 0
+			for b in range(job.num_tuples):
+				orbit_sizes[orbit_root(tuple_orbits, b)] += 1
+
+		# Find the s-tuples that induce one of the types.
+		num_embeddings = 0
+		for b in range(job.num_tuples):
+			if tuple_orbits[b] != b:
+				continue
+			pp = &job.p[b * job.tuple_len * n]
+			nm = raw_induced_edges(edges, ne, r, pp, s, induced)
+			raw_minimize_edges(induced, nm, r, job.oriented)
+			ti = find_flag(job.types, induced, nm)
+			if ti != -1:
+				embedding_tuples[num_embeddings] = b
+				embedding_types[num_embeddings] = ti
+				embedding_weights[num_embeddings] = orbit_sizes[b]
+				num_embeddings += 1
+
+		for e in range(num_embeddings):
+
+			b = embedding_tuples[e]
+			ti = embedding_types[e]
+			weight = embedding_weights[e]
+
+			pp = &job.p[b * job.tuple_len * n]
+			for j in range(s):
+				pf[j] = pp[j]
+			tuple_mask = vertex_mask(pp, s)
+			num_outside = 0
+			for j in range(1, n + 1):
+				if not tuple_mask & ((<uint64_t> 1) << j):
+					outside[num_outside] = j
+					num_outside += 1
+
+			# Find the flag on each subset of the other vertices.
+			for i in range(job.num_subsets1):
+				subset = &job.subsets1[i * (m1 - s)]
+				for j in range(m1 - s):
+					pf[s + j] = outside[subset[j]]
+				nm = raw_induced_edges(edges, ne, r, pf, m1, induced)
+				raw_make_minimal_isomorph(induced, nm, m1, s, r, job.oriented)
+				indices1[i] = find_flag(job.flags1[ti], induced, nm)
+
+			if not job.equal_flags_mode:
+				for i in range(job.num_subsets2):
+					subset = &job.subsets2[i * (m2 - s)]
+					for j in range(m2 - s):
+						pf[s + j] = outside[subset[j]]
+					nm = raw_induced_edges(edges, ne, r, pf, m2, induced)
+					raw_make_minimal_isomorph(induced, nm, m2, s, r, job.oriented)
+					indices2[i] = find_flag(job.flags2[ti], induced, nm)
+
+			for i in range(job.tuple_len):
+
+				f1index = indices1[job.pairs[2 * i]]
+				f2index = indices2[job.pairs[2 * i + 1]]
+				if f1index == -1 or f2index == -1:
+					continue
+
+				# In equal flags mode, (i, j) and (j, i) are counted together.
+				len2 = job.flags2[ti].len
+				if job.equal_flags_mode and f2index < f1index:
+					k = f2index * len2 + f1index
+				else:
+					k = f1index * len2 + f2index
+				grb = grbs[ti]
+				if grb[k] == 0:
+					toucheds[ti][num_touched[ti]] = k
+					num_touched[ti] += 1
+				grb[k] += weight
+
+		for ti in range(job.num_types):
+
+			if num_touched[ti] == 0:
+				continue
+
+			grb = grbs[ti]
+			touched = toucheds[ti]
+			len2 = job.flags2[ti].len
+			out = &outs[ti]
+			qsort(touched, num_touched[ti], sizeof(int), compare_ints)
+
+			for i in range(num_touched[ti]):
+				k = touched[i]
+				row = products_output_row(out)
+				row[0] = gi
+				row[1] = k / len2
+				row[2] = k % len2
+				row[3] = grb[k]
+				# the denominator counts ordered pairs, so (i, i) is counted twice
+				if job.equal_flags_mode and k / len2 == k % len2:
+					row[3] *= 2
+				grb[k] = 0
+
+			num_touched[ti] = 0
+
+	for ti in range(job.num_types):
+		free(grbs[ti])
+		free(toucheds[ti])
+	free(grbs)
+	free(toucheds)
+	free(num_touched)
+	free(embedding_tuples)
+	free(embedding_types)
+	free(embedding_weights)
+	free(tuple_orbits)
+	free(orbit_sizes)
+	free(indices1)
+	if not job.equal_flags_mode:
+		free(indices2)
+
+
+cdef class products_task:
+
+	cdef products_job *job
+	cdef int start, end, num_types
+	cdef products_output *outs
+
+	def __dealloc__(self):
+		cdef int i
+		cdef products_chunk *chunk, *next_chunk
+		if self.outs != NULL:
+			for i in range(self.num_types):
+				chunk = self.outs[i].first
+				while chunk != NULL:
+					next_chunk = chunk.next
+					free(chunk)
+					chunk = next_chunk
+			free(self.outs)
+
+	def run(self):
+
+		cdef products_job *job = self.job
+		cdef int start = self.start, end = self.end
+		cdef products_output *outs
+
+		self.num_types = job.num_types
+		self.outs = <products_output *> calloc(job.num_types, sizeof(products_output))
+		outs = self.outs
+
+		with nogil:
+			products_kernel(job, start, end, outs)
+
+
+#
+# A graph_block holds a list of flags for the C code. It can also hold a packed copy of
+# their edge lists, which can be used without the GIL, and a hash table of the edge
+# lists, so that a flag can be found in the list without comparing it with every flag.
+# These are made the first time they are needed. The flags in a block should all have
+# the same n, t, r and orientation.
+#
+
+cdef inline unsigned int hash_edges(int *edges, int ne, int r) nogil:
+
+	cdef int i
+	cdef unsigned int h = 2166136261u
+
+	h = (h ^ <unsigned int> ne) * 16777619u
+	for i in range(r * ne):
+		h = (h ^ <unsigned int> edges[i]) * 16777619u
+	return h
+
+
+cdef int find_flag(packed_flags *pf, int *edges, int ne) nogil:
+	"""
+	Returns the index of the first flag in pf with the given edge list, or -1 if there
+	isn't one.
+	"""
+	cdef int i, j, slot, *fe
+
+	slot = hash_edges(edges, ne, pf.r) & (pf.table_size - 1)
+	while pf.table[slot] != 0:
+		i = pf.table[slot] - 1
+		if pf.ne[i] == ne:
+			fe = &pf.edges[pf.offsets[i]]
+			for j in range(pf.r * ne):
+				if fe[j] != edges[j]:
+					break
+			else:
+				return i
+		slot = (slot + 1) & (pf.table_size - 1)
+	return -1
+
+
 cdef class graph_block:
-	pass
+
+	def __dealloc__(self):
+		free(self.graphs)
+		free(self.packed.ne)
+		free(self.packed.offsets)
+		free(self.packed.edges)
+		free(self.packed.table)
+
+
+	cdef packed_flags *pack(self):
+
+		cdef int i, j, slot, size = 0, r = 2
+		cdef HypergraphFlag g
+		cdef packed_flags *pf = &self.packed
+
+		if self.is_packed:
+			return pf
+
+		for i in range(self.len):
+			g = <HypergraphFlag> self.graphs[i]
+			size += g._r * g.ne
+			r = g._r
+
+		pf.len = self.len
+		pf.r = r
+		pf.ne = <int *> malloc((self.len + 1) * sizeof(int))
+		pf.offsets = <int *> malloc((self.len + 1) * sizeof(int))
+		pf.edges = <int *> malloc((size + 1) * sizeof(int))
+
+		size = 0
+		for i in range(self.len):
+			g = <HypergraphFlag> self.graphs[i]
+			pf.ne[i] = g.ne
+			pf.offsets[i] = size
+			for j in range(g._r * g.ne):
+				pf.edges[size + j] = g._edges[j]
+			size += g._r * g.ne
+
+		pf.table_size = 2
+		while pf.table_size < 2 * self.len:
+			pf.table_size *= 2
+		pf.table = <int *> calloc(pf.table_size, sizeof(int))
+
+		for i in range(self.len):
+			slot = hash_edges(&pf.edges[pf.offsets[i]], pf.ne[i], r) & (pf.table_size - 1)
+			while pf.table[slot] != 0:
+				slot = (slot + 1) & (pf.table_size - 1)
+			pf.table[slot] = i + 1
+
+		self.is_packed = True
+		return pf
+
+
+	cdef int index_of(self, HypergraphFlag g):
+		"""
+		Returns the index of the first flag in the block that is labelled-isomorphic to
+		g (i.e. has the same edge list), or -1 if there isn't one.
+		"""
+		cdef int i = find_flag(self.pack(), g._edges, g.ne)
+
+		if i != -1 and not g.is_labelled_isomorphic(<HypergraphFlag> self.graphs[i]):
+			return -1
+		return i
 
 
 def make_graph_block(graphs, n):
@@ -1968,3 +3375,239 @@ def print_graph_block(graph_block gb):
 	for i in range(gb.len):
 		g = <HypergraphFlag ?> gb.graphs[i]
 		print str(g)
+
+
+#
+# Lists of generated flags are cached on disk, so that running a problem again does not
+# generate them all again. Each list is stored in a .npz file, named after a hash of
+# everything that determines the list. Set flag_cache_directory to None to turn the
+# cache off. The cache is never cleaned up; the directory is printed the first time
+# that something is written to it.
+#
+# Cached flags are trusted to be minimal isomorphs, so FLAG_CACHE_VERSION is part of the
+# key, and must be increased whenever the canonical form, the generation of flags or the
+# file format changes.
+#
+
+FLAG_CACHE_VERSION = 2
+
+flag_cache_directory = os.path.join(DOT_SAGE, "flagmatic", "flag_cache")
+
+flag_cache_announced = False
+
+
+def flag_cache_key(n, tg, r, oriented, multiplicity, forbidden_edge_numbers, forbidden_graphs,
+	forbidden_induced_graphs, canonical_augmentation):
+	"""
+	Returns a string that determines the list of flags returned by generate_flags.
+	"""
+
+	def describe(things):
+		if things is None:
+			return "None"
+		return ",".join(sorted(str(x) for x in things))
+
+	return ";".join(["v%d" % FLAG_CACHE_VERSION, type(tg).__name__, str(r), str(oriented), str(multiplicity), str(n), str(tg),
+		describe(forbidden_edge_numbers), describe(forbidden_graphs), describe(forbidden_induced_graphs),
+		str(canonical_augmentation)])
+
+
+def flag_cache_filename(key):
+
+	return os.path.join(flag_cache_directory, hashlib.sha1(key).hexdigest() + ".npz")
+
+
+def load_cached_flags(key, n, HypergraphFlag tg):
+	"""
+	Returns the list of flags stored under key, or None if there isn't one.
+	"""
+
+	cdef int i, j, k, size
+	cdef HypergraphFlag ng
+
+	if flag_cache_directory is None:
+		return None
+
+	filename = flag_cache_filename(key)
+	if not os.path.isfile(filename):
+		return None
+
+	try:
+		data = numpy.load(filename)
+		try:
+			if str(data["key"]) != key:
+				return None
+			nes = data["ne"]
+			edges = data["edges"]
+		finally:
+			data.close()
+	except (IOError, ValueError, KeyError):
+		return None
+
+	flags = []
+	k = 0
+	for i in range(len(nes)):
+		ng = type(tg)()
+		ng._n = n
+		ng._r = tg._r
+		ng._oriented = tg._oriented
+		ng._multiplicity = tg._multiplicity
+		ng._t = tg._n
+		ng.ne = nes[i]
+		size = ng._r * ng.ne
+		for j in range(size):
+			ng._edges[j] = edges[k + j]
+		k += size
+		ng._certified_minimal_isomorph = True
+		flags.append(ng)
+
+	return flags
+
+
+def save_cached_flags(key, flags):
+	"""
+	Stores the list of flags under key. Nothing happens if the file cannot be written.
+	"""
+	cdef int i
+	cdef HypergraphFlag g
+
+	global flag_cache_announced
+
+	if flag_cache_directory is None:
+		return
+
+	if not flag_cache_announced:
+		sys.stdout.write("Storing generated flags in %s (set hypergraph_flag.flag_cache_directory to None to turn this off).\n"
+			% flag_cache_directory)
+		flag_cache_announced = True
+
+	nes = numpy.array([g.ne for g in flags], dtype=numpy.uint8)
+	edges = []
+	for g in flags:
+		for i in range(g._r * g.ne):
+			edges.append(g._edges[i])
+	edges = numpy.array(edges, dtype=numpy.uint8)
+
+	try:
+		if not os.path.isdir(flag_cache_directory):
+			os.makedirs(flag_cache_directory)
+		# Write to a temporary file first, so that other processes never see half a file.
+		f = tempfile.NamedTemporaryFile(dir=flag_cache_directory, suffix=".npz", delete=False)
+		with f:
+			numpy.savez_compressed(f, key=numpy.array(key), ne=nes, edges=edges)
+		os.rename(f.name, flag_cache_filename(key))
+	except (IOError, OSError):
+		pass
+
+
+#
+# Flag products are stored on disk as well, so that problems with the same admissible
+# graphs, type and flags can share them. Each array is stored in a .npy file, which is
+# loaded memory-mapped, and its denominator is stored in a .txt file next to it. Both
+# are named after a hash of the graphs, type and flags. A process that is computing
+# products holds a lock on them, so that another process that wants the same products
+# waits for them rather than computing them too. Set product_cache_directory to None to
+# turn the store off. The store is never cleaned up, so large problems can leave large
+# files there; the directory is printed the first time that something is written to it.
+#
+# PRODUCT_CACHE_VERSION is part of the key, and must be increased whenever the layout of
+# the arrays, or the way the products are computed, changes.
+#
+
+PRODUCT_CACHE_VERSION = 2
+
+product_cache_directory = os.path.join(DOT_SAGE, "flagmatic", "product_cache")
+
+product_cache_announced = False
+
+
+def product_cache_key(graphs, tg, flags):
+	"""
+	Returns a string that determines the products of the flags in the graphs.
+	"""
+
+	return hashlib.sha1(";".join(["v%d" % PRODUCT_CACHE_VERSION, type(tg).__name__, str(tg), ",".join(str(g) for g in flags),
+		",".join(str(g) for g in graphs)])).hexdigest()
+
+
+def product_cache_filename(key, extension):
+
+	return os.path.join(product_cache_directory, key + extension)
+
+
+def load_cached_products(key):
+	"""
+	Returns the pair (rarray, denominator) stored under key, or None if there isn't one.
+	The array is memory-mapped and read-only.
+	"""
+
+	if product_cache_directory is None:
+		return None
+
+	try:
+		with open(product_cache_filename(key, ".txt")) as f:
+			stored_key, denominator = f.read().split()
+		if stored_key != key:
+			return None
+		rarray = numpy.load(product_cache_filename(key, ".npy"), mmap_mode="r")
+	except (IOError, ValueError):
+		return None
+
+	return rarray, Integer(denominator)
+
+
+def save_cached_products(key, rarray, denominator):
+	"""
+	Stores rarray and denominator under key. Nothing happens if the files cannot be
+	written.
+	"""
+	global product_cache_announced
+
+	if product_cache_directory is None:
+		return
+
+	if not product_cache_announced:
+		sys.stdout.write("\nStoring flag products in %s (set hypergraph_flag.product_cache_directory to None to turn this off).\n"
+			% product_cache_directory)
+		product_cache_announced = True
+
+	try:
+		if not os.path.isdir(product_cache_directory):
+			os.makedirs(product_cache_directory)
+		# The .txt file is written last, so that other processes never see half an array.
+		f = tempfile.NamedTemporaryFile(dir=product_cache_directory, suffix=".npy", delete=False)
+		with f:
+			numpy.save(f, rarray)
+		os.rename(f.name, product_cache_filename(key, ".npy"))
+		f = tempfile.NamedTemporaryFile(dir=product_cache_directory, suffix=".txt", delete=False)
+		with f:
+			f.write("%s %s\n" % (key, denominator))
+		os.rename(f.name, product_cache_filename(key, ".txt"))
+	except (IOError, OSError):
+		pass
+
+
+def lock_cached_products(key):
+	"""
+	Waits until no other process holds the lock on the products stored under key, and
+	then takes it. Returns a file, which should be closed to release the lock, or None
+	if the lock cannot be taken.
+	"""
+
+	if product_cache_directory is None:
+		return None
+
+	try:
+		if not os.path.isdir(product_cache_directory):
+			os.makedirs(product_cache_directory)
+		f = open(product_cache_filename(key, ".lock"), "a")
+	except (IOError, OSError):
+		return None
+
+	try:
+		fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+	except IOError:
+		f.close()
+		return None
+
+	return f
@@ -39,7 +39,7 @@ cdef class MultigraphFlag (HypergraphFlag):
 
 
 	def __reduce__(self):
-		return (type(self), (self._repr_(),))
+		return (type(self), (self._multiplicity, self._repr_()))
 	
 	
 	@classmethod
@@ -48,15 +48,19 @@ cdef class MultigraphFlag (HypergraphFlag):
 
 
 	@classmethod
-	def generate_flags(cls, n, tg, multiplicity=1, forbidden_edge_numbers=None, forbidden_graphs=None, forbidden_induced_graphs=None):
+	def generate_flags(cls, n, tg, multiplicity=1, forbidden_edge_numbers=None, forbidden_graphs=None, forbidden_induced_graphs=None,
+		canonical_augmentation=False, processes=None):
 		return HypergraphFlag.generate_flags(n, tg, r=2, oriented=False, multiplicity=multiplicity, forbidden_edge_numbers=forbidden_edge_numbers,
-			forbidden_graphs=forbidden_graphs, forbidden_induced_graphs=forbidden_induced_graphs)
+			forbidden_graphs=forbidden_graphs, forbidden_induced_graphs=forbidden_induced_graphs, canonical_augmentation=canonical_augmentation,
+			processes=processes)
 
 
 	@classmethod
-	def generate_graphs(cls, n, multiplicity=1, forbidden_edge_numbers=None, forbidden_graphs=None, forbidden_induced_graphs=None):
+	def generate_graphs(cls, n, multiplicity=1, forbidden_edge_numbers=None, forbidden_graphs=None, forbidden_induced_graphs=None,
+		canonical_augmentation=False, processes=None):
 		return HypergraphFlag.generate_flags(n, cls(), r=2, oriented=False, multiplicity=multiplicity, forbidden_edge_numbers=forbidden_edge_numbers,
-			forbidden_graphs=forbidden_graphs, forbidden_induced_graphs=forbidden_induced_graphs)
+			forbidden_graphs=forbidden_graphs, forbidden_induced_graphs=forbidden_induced_graphs, canonical_augmentation=canonical_augmentation,
+			processes=processes)
 
 
 	def Graph(self):
@@ -88,6 +92,10 @@ cdef class TwoMultigraphFlag (MultigraphFlag):
 		super(MultigraphFlag, self).__init__(representation=representation, r=2, oriented=False, multiplicity=2)
 
 
+	def __reduce__(self):
+		return (type(self), (self._repr_(),))
+
+
 	@classmethod
 	def description(cls):
 		return "2-multigraph"
@@ -98,15 +106,19 @@ cdef class TwoMultigraphFlag (MultigraphFlag):
 		return 2 * binomial(n, 2)
 
 	@classmethod
-	def generate_flags(cls, n, tg, forbidden_edge_numbers=None, forbidden_graphs=None, forbidden_induced_graphs=None):
+	def generate_flags(cls, n, tg, forbidden_edge_numbers=None, forbidden_graphs=None, forbidden_induced_graphs=None,
+		canonical_augmentation=False, processes=None):
 		return HypergraphFlag.generate_flags(n, tg, r=2, oriented=False, multiplicity=2, forbidden_edge_numbers=forbidden_edge_numbers,
-			forbidden_graphs=forbidden_graphs, forbidden_induced_graphs=forbidden_induced_graphs)
+			forbidden_graphs=forbidden_graphs, forbidden_induced_graphs=forbidden_induced_graphs, canonical_augmentation=canonical_augmentation,
+			processes=processes)
 
 
 	@classmethod
-	def generate_graphs(cls, n, forbidden_edge_numbers=None, forbidden_graphs=None, forbidden_induced_graphs=None):
+	def generate_graphs(cls, n, forbidden_edge_numbers=None, forbidden_graphs=None, forbidden_induced_graphs=None,
+		canonical_augmentation=False, processes=None):
 		return HypergraphFlag.generate_flags(n, cls(), r=2, oriented=False, multiplicity=2, forbidden_edge_numbers=forbidden_edge_numbers,
-			forbidden_graphs=forbidden_graphs, forbidden_induced_graphs=forbidden_induced_graphs)
+			forbidden_graphs=forbidden_graphs, forbidden_induced_graphs=forbidden_induced_graphs, canonical_augmentation=canonical_augmentation,
+			processes=processes)
 
 
 cdef class ThreeMultigraphFlag (MultigraphFlag):
@@ -115,6 +127,10 @@ cdef class ThreeMultigraphFlag (MultigraphFlag):
 		super(MultigraphFlag, self).__init__(representation=representation, r=2, oriented=False, multiplicity=3)
 
 
+	def __reduce__(self):
+		return (type(self), (self._repr_(),))
+
+
 	@classmethod
 	def description(cls):
 		return "3-multigraph"
@@ -125,12 +141,16 @@ cdef class ThreeMultigraphFlag (MultigraphFlag):
 		return 3 * binomial(n, 2)
 
 	@classmethod
-	def generate_flags(cls, n, tg, forbidden_edge_numbers=None, forbidden_graphs=None, forbidden_induced_graphs=None):
+	def generate_flags(cls, n, tg, forbidden_edge_numbers=None, forbidden_graphs=None, forbidden_induced_graphs=None,
+		canonical_augmentation=False, processes=None):
 		return HypergraphFlag.generate_flags(n, tg, r=2, oriented=False, multiplicity=3, forbidden_edge_numbers=forbidden_edge_numbers,
-			forbidden_graphs=forbidden_graphs, forbidden_induced_graphs=forbidden_induced_graphs)
+			forbidden_graphs=forbidden_graphs, forbidden_induced_graphs=forbidden_induced_graphs, canonical_augmentation=canonical_augmentation,
+			processes=processes)
 
 
 	@classmethod
-	def generate_graphs(cls, n, forbidden_edge_numbers=None, forbidden_graphs=None, forbidden_induced_graphs=None):
+	def generate_graphs(cls, n, forbidden_edge_numbers=None, forbidden_graphs=None, forbidden_induced_graphs=None,
+		canonical_augmentation=False, processes=None):
 		return HypergraphFlag.generate_flags(n, cls(), r=2, oriented=False, multiplicity=3, forbidden_edge_numbers=forbidden_edge_numbers,
-			forbidden_graphs=forbidden_graphs, forbidden_induced_graphs=forbidden_induced_graphs)
+			forbidden_graphs=forbidden_graphs, forbidden_induced_graphs=forbidden_induced_graphs, canonical_augmentation=canonical_augmentation,
+			processes=processes)
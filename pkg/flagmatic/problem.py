@@ -28,19 +28,22 @@ SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 """
 
-import gzip, json, os, sys
+import gzip, json, multiprocessing, os, re, sys, tempfile, threading
 import numpy
 import pexpect
+from collections import deque, namedtuple
 
 from sage.structure.sage_object import SageObject
-from sage.rings.all import Integer, QQ, ZZ, RDF
+from sage.rings.all import Integer, QQ, ZZ, RDF, GF
 from sage.functions.other import floor
 from sage.matrix.all import matrix, identity_matrix, block_matrix, block_diagonal_matrix
 from sage.modules.misc import gram_schmidt
+from sage.modules.free_module_element import vector
 from sage.misc.misc import SAGE_TMP 
 from copy import copy
 
-from hypergraph_flag import make_graph_block
+from hypergraph_flag import make_graph_block, product_cache_key, load_cached_products, save_cached_products, \
+    lock_cached_products
 from flag import *
 from three_graph_flag import *
 from graph_flag import *
@@ -57,6 +60,25 @@ sdpa_dd_cmd = "sdpa_dd"
 sdpa_qd_cmd = "sdpa_qd"
 dsdp_cmd = "dsdp"
 
+# The default CSDP parameters, except for the tolerances axtol, atytol and objtol.
+csdp_params = """axtol=%g
+atytol=%g
+objtol=%g
+pinftol=1.0e8
+dinftol=1.0e8
+maxiter=100
+minstepfrac=0.90
+maxstepfrac=0.97
+minstepp=1.0e-8
+minstepd=1.0e-8
+usexzgap=1
+tweakgap=0
+affine=0
+printlevel=1
+perturbobj=1
+fastmode=0
+"""
+
 
 def block_structure(M):
     r"""
@@ -123,6 +145,357 @@ def LDLdecomposition(M):  # TODO: does this handle matrices with zero eigenvalue
     return L, D
 
 
+def write_sdpa_entries(f, matrix_indices, block_indices, rows, cols, values, chunk_size=1000000):
+    r"""
+    Writes lines "matrix block row col value" in SDPA sparse format to the file f. The
+    first four arguments are integer arrays and values is an array of strings, all of the
+    same length. The lines are put together with NumPy a chunk at a time, and each chunk
+    is written with a single call.
+    """
+    for start in range(0, len(values), chunk_size):
+        end = start + chunk_size
+        lines = matrix_indices[start:end].astype(str)
+        for column in [block_indices[start:end].astype(str), rows[start:end].astype(str),
+                       cols[start:end].astype(str), values[start:end]]:
+            lines = numpy.char.add(numpy.char.add(lines, " "), column)
+        f.write("\n".join(lines.tolist()))
+        f.write("\n")
+
+
+def exact_product_sums(args):
+    r"""
+    Returns the contribution of one type to the bounds, as a pair (graph indices, sums),
+    where each sum is a Python integer. args is a tuple (entries, n, rows) in which entries
+    is the n x n matrix Q multiplied by the lcm of the denominators of its entries, given as
+    a flat list of Python integers, and rows is the product densities array of the type.
+    The sum for a graph is then the sum of numer * Q[j, k] over its rows (doubled when j and
+    k differ), so the true contribution is this divided by the product denominator and the
+    lcm. Everything is exact: the arithmetic is done on NumPy object arrays of Python
+    integers. The function takes a single tuple of arguments so that it can be given to a
+    multiprocessing.Pool.
+    """
+    entries, n, rows = args
+    rows = numpy.asarray(rows)
+    if len(rows) == 0:
+        return [], []
+
+    gis = rows[:, 0]
+    if numpy.any(gis[1:] < gis[:-1]):
+        rows = rows[numpy.argsort(gis, kind="mergesort")]
+        gis = rows[:, 0]
+    js = rows[:, 1]
+    ks = rows[:, 2]
+
+    Q = numpy.empty(n * n, dtype=object)
+    Q[:] = entries
+    Q = Q.reshape(n, n)
+
+    weights = numpy.where(js != ks, 2, 1) * rows[:, 3].astype(numpy.int64)
+    values = weights.astype(object) * Q[js, ks]
+    starts = numpy.concatenate(([0], numpy.nonzero(gis[1:] != gis[:-1])[0] + 1))
+    sums = numpy.add.reduceat(values, starts)
+    return gis[starts].tolist(), [int(s) for s in sums]
+
+
+class IncrementalEchelonForm(object):
+    r"""
+    The span of a growing list of vectors, kept in echelon form so that each new vector is
+    only reduced against the pivot rows found so far, rather than the whole matrix being
+    echelonized again.
+
+    Over QQ the reduction is done modulo a large prime first. A vector that is independent of
+    the others modulo the prime is also independent of them over QQ, so it is accepted
+    straight away. A vector that appears to be dependent is reduced again exactly, against an
+    exact echelon form of the accepted vectors that is only built when it is first needed, and
+    is only rejected if it really is dependent. If a vector has a denominator divisible by the
+    prime, or the prime turns out to be unlucky, or the field is not QQ, all the reduction is
+    done exactly from then on.
+    """
+
+    def __init__(self, field, length, prime=2147483647):
+
+        self.field = field
+        self.length = length
+        self.vectors = []
+        self._ring = GF(prime) if field == QQ else field
+        self._pivots = []
+        self._rows = []
+        self._exact_pivots = []
+        self._exact_rows = []
+
+    def rank(self):
+        return len(self.vectors)
+
+    def is_full(self):
+        return len(self.vectors) == self.length
+
+    @staticmethod
+    def _reduce(v, pivots, rows):
+        for pivot, row in zip(pivots, rows):
+            if v[pivot] != 0:
+                v -= v[pivot] * row
+        return v
+
+    @staticmethod
+    def _insert(v, pivots, rows):
+        pivot = v.nonzero_positions()[0]
+        pivots.append(pivot)
+        rows.append(v[pivot] ** -1 * v)
+
+    def _exact_reduce(self, v):
+        # Bring the exact echelon form up to date with the accepted vectors first.
+        for u in self.vectors[len(self._exact_rows):]:
+            self._insert(self._reduce(vector(self.field, u), self._exact_pivots, self._exact_rows),
+                         self._exact_pivots, self._exact_rows)
+        return self._reduce(vector(self.field, v), self._exact_pivots, self._exact_rows)
+
+    def add(self, v):
+        r"""
+        If v is independent of the vectors added so far, adds it and returns True. Otherwise
+        returns False.
+        """
+        v = list(v)
+
+        if self._ring != self.field:
+            try:
+                w = self._reduce(vector(self._ring, v), self._pivots, self._rows)
+            except ZeroDivisionError:
+                w = None
+            if not w is None:
+                if not w.is_zero():
+                    self._insert(w, self._pivots, self._rows)
+                    self.vectors.append(v)
+                    return True
+                if self._exact_reduce(v).is_zero():
+                    return False
+            # The prime cannot be used for v, so carry on using exact arithmetic.
+            self._ring = self.field
+            self._pivots = []
+            self._rows = []
+            self._exact_reduce(v)
+            self._pivots, self._rows = self._exact_pivots, self._exact_rows
+
+        w = self._reduce(vector(self._ring, v), self._pivots, self._rows)
+        if w.is_zero():
+            return False
+        self._insert(w, self._pivots, self._rows)
+        self.vectors.append(v)
+        return True
+
+
+class ApproximateMatrices(object):
+    r"""
+    A list of square matrices over the approximate field. Each one is given either as a NumPy
+    array, which is only made into an (immutable) Sage matrix the first time it is looked at,
+    or as a Sage matrix. Every matrix can also be had as a float64 NumPy array, through
+    ``array`` or the ``arrays`` attribute.
+    """
+
+    def __init__(self, field, matrices):
+
+        self.field = field
+        self._arrays = [m if isinstance(m, numpy.ndarray) else None for m in matrices]
+        self._matrices = [None if isinstance(m, numpy.ndarray) else m for m in matrices]
+        for M in self._matrices:
+            if not M is None:
+                M.set_immutable()
+
+    def __len__(self):
+        return len(self._matrices)
+
+    def __getitem__(self, i):
+        if self._matrices[i] is None:
+            a = self._arrays[i]
+            M = matrix(self.field, a) if a.size > 0 else matrix(self.field, a.shape[0], a.shape[1])
+            M.set_immutable()
+            self._matrices[i] = M
+        return self._matrices[i]
+
+    def __iter__(self):
+        for i in range(len(self._matrices)):
+            yield self[i]
+
+    def array(self, i):
+        if self._arrays[i] is None:
+            self._arrays[i] = self._matrices[i].numpy(dtype=float)
+        return self._arrays[i]
+
+    @property
+    def arrays(self):
+        return [self.array(i) for i in range(len(self._matrices))]
+
+
+class SolverProgress(namedtuple("SolverProgress", ["iteration", "primal_objective", "dual_objective", "gap"])):
+    r"""
+    An iteration that an SDP solver has reported. The objective values are as the solver prints
+    them, so for maximization problems they have the opposite sign to the bound. The gap is the
+    relative gap |primal - dual| / (1 + |primal| + |dual|).
+    """
+    __slots__ = ()
+
+
+class SolverLog(object):
+    r"""
+    Keeps the output of an SDP solver. Each line is written to a log file, which is moved to
+    filename + ".1" when it gets bigger than max_bytes, and the last max_lines lines are kept in
+    memory. The lines that report iterations are parsed, so that ``progress`` can be looked at
+    while the solver runs.
+    """
+
+    def __init__(self, filename, solver, max_lines=1000, max_bytes=16 * 1024 * 1024):
+
+        self.filename = filename
+        self.solver = solver
+        self.progress = None
+        self._max_bytes = max_bytes
+        self._lines = deque(maxlen=max_lines)
+        self._lock = threading.Lock()
+        self._file = open(filename, "w")
+        self._size = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        state["_file"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return "".join(self.lines())
+
+    def lines(self):
+        r"""
+        Returns a list of the lines that are kept in memory.
+        """
+        with self._lock:
+            return list(self._lines)
+
+    def write(self, line):
+        r"""
+        Adds a line of output, which should end with a newline.
+        """
+        with self._lock:
+            self._lines.append(line)
+            if self._file is not None:
+                if self._size + len(line) > self._max_bytes:
+                    self._file.close()
+                    os.rename(self.filename, self.filename + ".1")
+                    self._file = open(self.filename, "w")
+                    self._size = 0
+                self._file.write(line)
+                self._size += len(line)
+        progress = self._parse_progress(line)
+        if progress is not None:
+            self.progress = progress
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _parse_progress(self, line):
+
+        words = line.split()
+        try:
+            if self.solver == "csdp":
+                # Iter:  3 Ap: 9.00e-01 Pobj:  3.9419437e+00 Ad: 9.00e-01 Dobj:  5.2390063e-01
+                match = re.search(r"Iter:\s*(\d+).*Pobj:\s*(\S+).*Dobj:\s*(\S+)", line)
+                if match is None:
+                    return None
+                iteration, primal, dual = int(match.group(1)), float(match.group(2)), float(match.group(3))
+            elif "sdpa" in self.solver:
+                # iteration, mu, thetaP, thetaD, objP, objD, alphaP, alphaD, beta
+                if len(words) != 9:
+                    return None
+                iteration, primal, dual = int(words[0]), float(words[4]), float(words[5])
+            else:
+                # iteration, primal objective, dual objective, ...
+                if len(words) < 3:
+                    return None
+                iteration, primal, dual = int(words[0]), float(words[1]), float(words[2])
+        except ValueError:
+            return None
+
+        gap = abs(primal - dual) / (1 + abs(primal) + abs(dual))
+        return SolverProgress(iteration, primal, dual, gap)
+
+
+class SDPSolve(object):
+    r"""
+    An SDP solve that is running in the background, as returned by ``Problem.solve_sdp_async``.
+    A thread follows the solver, and then calls complete(self).
+    """
+
+    def __init__(self, process, log, complete):
+
+        self._process = process
+        self._log = log
+        self._cancelled = False
+        self._exception = None
+
+        def run():
+            try:
+                complete(self)
+            except Exception as e:
+                self._exception = e
+
+        self._thread = threading.Thread(target=run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def done(self):
+        r"""
+        Returns True if the solve has finished, or has been cancelled.
+        """
+        return not self._thread.is_alive()
+
+    def cancelled(self):
+        r"""
+        Returns True if the solve was cancelled.
+        """
+        return self._cancelled
+
+    def wait(self, timeout=None):
+        r"""
+        Waits for the solve to finish, or for timeout seconds if timeout is not None. Returns
+        True if it has finished.
+        """
+        self._thread.join(timeout)
+        return self.done()
+
+    def result(self):
+        r"""
+        Waits for the solve to finish. Raises ValueError if it was cancelled, or the exception
+        that stopped it, if there was one.
+        """
+        self.wait()
+        if self._cancelled:
+            raise ValueError("the solve was cancelled.")
+        if self._exception is not None:
+            raise self._exception
+
+    def progress(self):
+        r"""
+        Returns the last iteration reported by the SDP solver, as a ``SolverProgress``, or None
+        if it has not reported one yet.
+        """
+        return self._log.progress
+
+    def cancel(self):
+        r"""
+        Stops the SDP solver. Returns True if it was still running.
+        """
+        if self.done():
+            return False
+        self._cancelled = True
+        self._process.terminate(force=True)
+        return True
+
+
 class Problem(SageObject):
     r"""
     This is the principal class of flagmatic. Objects of this class represent Turán-type
@@ -131,7 +504,8 @@ class Problem(SageObject):
 
     def __init__(self, flag_cls, order=None, forbid_induced=None, forbid=None,
                  forbid_homomorphic_images=False, density=None, minimize=False,
-                 type_orders=None, types=None, max_flags=None, compute_products=True):
+                 type_orders=None, types=None, max_flags=None, compute_products=True,
+                 canonical_augmentation=False, processes=None):
         r"""
         Creates a new Problem object. Generally it is not necessary to call this method
         directly, as Problem objects are more easily created using the helper functions:
@@ -184,7 +558,31 @@ class Problem(SageObject):
 
         if not order is None:
             self.generate_flags(order, type_orders=type_orders, types=types, max_flags=max_flags,
-                                compute_products=compute_products)
+                                compute_products=compute_products, canonical_augmentation=canonical_augmentation,
+                                processes=processes)
+
+    def __setstate__(self, state):
+
+        self.__dict__.update(state)
+
+        # Problems saved by older versions store the denominator of the products as a fifth
+        # column of each product array, rather than in _product_densities_denominators.
+        if "_product_densities_arrays" in state and not "_product_densities_denominators" in state:
+            arrays = self._product_densities_arrays
+            self._product_densities_denominators = [None for a in arrays]
+            for ti, a in enumerate(arrays):
+                if a is None:
+                    continue
+                a = numpy.asarray(a).reshape(-1, 5)
+                if numpy.any(a[:, 4] != a[:1, 4]):
+                    raise ValueError("cannot read the products of type %d of this saved problem." % ti)
+                self._product_densities_denominators[ti] = Integer(a[0, 4]) if len(a) > 0 else Integer(1)
+                arrays[ti] = numpy.array(a[:, :4], dtype=numpy.int32)
+
+        # They also store the Q matrices of the SDP solution as a plain list.
+        if isinstance(state.get("_sdp_Q_matrices"), list):
+            self._sdp_Q_matrices = ApproximateMatrices(getattr(self, "_approximate_field", RDF),
+                                                       self._sdp_Q_matrices)
 
     def state(self, state_name=None, action=None):
         r"""
@@ -360,7 +758,8 @@ class Problem(SageObject):
 
     # TODO: sanity checking of type orders
 
-    def generate_flags(self, order, type_orders=None, types=None, max_flags=None, compute_products=True):
+    def generate_flags(self, order, type_orders=None, types=None, max_flags=None, compute_products=True,
+                       canonical_augmentation=False, processes=None):
         r"""
         Generates the types and flags that will be used in the problem.
 
@@ -384,6 +783,15 @@ class Problem(SageObject):
            will be computed. For some large problems this may take a long time. If False,
            then the flag products must be computed later using the ``compute_products``
            method.
+
+         - ``canonical_augmentation`` -- (default: False) Boolean. If True then the graphs,
+           types and flags are generated by canonical augmentation, which avoids comparing
+           each new flag against all the flags found so far. The graphs may come out in a
+           different order.
+
+         - ``processes`` -- (default: None) None, or an integer. If an integer greater than 1
+           is given, then the graphs, types and flags are generated using that many worker
+           processes, and the flag products are computed using that many threads.
         """
 
         n = order
@@ -402,7 +810,8 @@ class Problem(SageObject):
 
         sys.stdout.write("Generating graphs...\n")
         self._graphs = self._flag_cls.generate_graphs(n, forbidden_edge_numbers=self._forbidden_edge_numbers,
-                                                      forbidden_graphs=self._forbidden_graphs, forbidden_induced_graphs=self._forbidden_induced_graphs)
+                                                      forbidden_graphs=self._forbidden_graphs, forbidden_induced_graphs=self._forbidden_induced_graphs,
+                                                      canonical_augmentation=canonical_augmentation, processes=processes)
         sys.stdout.write("Generated %d graphs.\n" % len(self._graphs))
 
         for g in self._graphs:    # Make all the graphs immutable
@@ -427,7 +836,8 @@ class Problem(SageObject):
 
             these_types = self._flag_cls.generate_graphs(s, forbidden_edge_numbers=self._forbidden_edge_numbers,
                                                          forbidden_graphs=self._forbidden_graphs,
-                                                         forbidden_induced_graphs=self._forbidden_induced_graphs)
+                                                         forbidden_induced_graphs=self._forbidden_induced_graphs,
+                                                         canonical_augmentation=canonical_augmentation, processes=processes)
 
             if types:
                 these_types = [h for h in these_types if h in allowed_types]
@@ -438,7 +848,9 @@ class Problem(SageObject):
             for tg in these_types:
                 these_flags.append(self._flag_cls.generate_flags(m, tg, forbidden_edge_numbers=self._forbidden_edge_numbers,
                                                                  forbidden_graphs=self._forbidden_graphs,
-                                                                 forbidden_induced_graphs=self._forbidden_induced_graphs))
+                                                                 forbidden_induced_graphs=self._forbidden_induced_graphs,
+                                                                 canonical_augmentation=canonical_augmentation,
+                                                                 processes=processes))
             sys.stdout.write("with %s flags of order %d.\n" % ([len(L) for L in these_flags], m))
 
             self._types.extend(these_types)
@@ -464,8 +876,15 @@ class Problem(SageObject):
                 g.set_immutable()
 
         if compute_products:
-            self.compute_products()
+            self.compute_products(threads=processes)
+
 
+    @property
+    def sdp_solver_log(self):
+        r"""
+        Read-only. The ``SolverLog`` of the last run of the SDP solver, or None.
+        """
+        return getattr(self, "_sdp_solver_log", None)
 
     @property
     def graphs(self):
@@ -1079,34 +1498,91 @@ class Problem(SageObject):
                 self._inverse_flag_bases.append(MT)
 
 
-    def compute_products(self):
+    def compute_products(self, threads=None, orbits=False):
         r"""
         Computes the products of the flags. This method is by default called from
         ``generate_flags``, and so would normally not need to be invoked directly.
+
+        The products are stored on disk (see ``hypergraph_flag.product_cache_directory``),
+        and are loaded from there if the same graphs, type and flags have been seen before.
+        If another process is computing the same products, this waits for them. The store
+        is not cleaned up automatically, so its files may need to be removed by hand.
+
+        INPUT:
+
+         - ``threads`` -- (default: None) None, or an integer. If an integer greater than 1
+           is given, then the admissible graphs are shared out between that many threads.
+
+         - ``orbits`` -- (default: False) Boolean. If True then the automorphism group of
+           each admissible graph is computed, and only one type embedding in each of its
+           orbits is looked at. This is quicker when there are many symmetric graphs.
         """
         self.state("compute_products", "yes")
 
         num_types = len(self._types)
         graph_block = make_graph_block(self._graphs, self._n)
-        self._product_densities_arrays = []
+        self._product_densities_arrays = [None for ti in range(num_types)]
+        self._product_densities_denominators = [None for ti in range(num_types)]
 
         sys.stdout.write("Computing products")
 
-        for ti in range(num_types):
+        # All the types of the same order are done together.
+        for s in sorted(set(tg.n for tg in self._types)):
 
-            tg = self._types[ti]
-            s = tg.n
+            tis = [ti for ti in range(num_types) if self._types[ti].n == s]
             m = (self._n + s) / 2
 
-            flags_block = make_graph_block(self._flags[ti], m)
-            rarray = self._flag_cls.flag_products(graph_block, tg, flags_block, None)
-            self._product_densities_arrays.append(rarray)
+            keys = dict((ti, product_cache_key(self._graphs, self._types[ti], self._flags[ti])) for ti in tis)
+            missing = [ti for ti in tis if not self._load_products(ti, keys[ti])]
 
-            sys.stdout.write(".")
+            # The locks are taken in order of key, so that two processes cannot wait for each other.
+            locks = []
+            try:
+                for ti in sorted(missing, key=lambda ti: keys[ti]):
+                    locks.append(lock_cached_products(keys[ti]))
+                missing = [ti for ti in missing if not self._load_products(ti, keys[ti])]
+
+                if len(missing) > 0:
+                    flags_blocks = [make_graph_block(self._flags[ti], m) for ti in missing]
+                    rarrays = self._flag_cls.multiple_flag_products(graph_block, [self._types[ti] for ti in missing],
+                                                                    flags_blocks, None, threads=threads, orbits=orbits)
+                    for ti, (rarray, denominator) in zip(missing, rarrays):
+                        self._product_densities_arrays[ti] = rarray
+                        self._product_densities_denominators[ti] = Integer(denominator)
+                        save_cached_products(keys[ti], rarray, denominator)
+            finally:
+                for lock in locks:
+                    if not lock is None:
+                        lock.close()
+
+            sys.stdout.write("." * len(tis))
             sys.stdout.flush()
 
         sys.stdout.write("\n")
 
+    def _load_products(self, ti, key):
+        """
+        Loads the products for type ti from the store, and returns True if they were
+        there.
+        """
+        stored = load_cached_products(key)
+        if stored is None:
+            return False
+        self._product_densities_arrays[ti], self._product_densities_denominators[ti] = stored
+        return True
+
+    def _working_directory(self):
+        """
+        Returns a directory in SAGE_TMP that only this Problem uses, for the SDP solver's files,
+        so that several problems can be solved at once. A copy of the Problem in another process
+        gets a directory of its own.
+        """
+        if (getattr(self, "_working_directory_pid", None) != os.getpid()
+                or not os.path.isdir(self._working_directory_name)):
+            self._working_directory_name = tempfile.mkdtemp(prefix="problem-", dir=unicode(SAGE_TMP))
+            self._working_directory_pid = os.getpid()
+        return self._working_directory_name
+
     def _set_block_matrix_structure(self):
 
         self.state("set_block_matrix_structure", "yes")
@@ -1150,7 +1626,7 @@ class Problem(SageObject):
     def solve_sdp(self, show_output=False, solver="csdp",
         force_sharp_graphs=False, force_zero_eigenvectors=False,
         check_solution=True, tolerance=1e-5, show_sorted=False, show_all=False,
-        use_initial_point=False, import_solution_file=None):
+        use_initial_point=False, import_solution_file=None, stream_input=False, relax_tolerances=False):
         r"""
         Solves a semi-definite program to get a bound on the problem.
 
@@ -1203,17 +1679,28 @@ class Problem(SageObject):
             solver will not be run; instead the output file from a previous run of an SDP solver
             will be read. Care should be taken to ensure that the file being imported is for
             exactly the same problem, as minimal sanity-checking is done.
+
+          - ``stream_input`` - Boolean (default: False). If True, then the SDP is not written to
+            a file first. Instead, it is written into a named pipe while the SDP solver reads it,
+            so that writing and reading overlap and no copy of the SDP is kept on disk. This only
+            works with CSDP.
+
+          - ``relax_tolerances`` - Boolean (default: False). If True, and a construction has
+            been set, then CSDP's tolerances for the relative duality gap and infeasibilities are
+            loosened from 1e-8 to ``tolerance`` / 10, so that it stops sooner. The solution is
+            less accurate, but this is usually enough for ``check_solution`` and ``make_exact``,
+            which round it anyway. The target bound is not used to decide when to stop; the
+            solver's progress towards it is only reported. This only works with CSDP.
         """
 
         if import_solution_file is None:
 
-            if self.state("write_sdp_input_file") != "yes":
-                self.write_sdp_input_file(force_sharp_graphs=force_sharp_graphs,
-                                          force_zero_eigenvectors=force_zero_eigenvectors)
-            if use_initial_point and self.state("write_sdp_initial_point_file") != "yes":
-                self.write_sdp_initial_point_file()
+            self._prepare_sdp_solver_input(solver=solver, force_sharp_graphs=force_sharp_graphs,
+                                           force_zero_eigenvectors=force_zero_eigenvectors,
+                                           use_initial_point=use_initial_point, stream_input=stream_input)
             self._run_sdp_solver(show_output=show_output, solver=solver,
-                                 use_initial_point=use_initial_point)
+                                 use_initial_point=use_initial_point,
+                                 solver_tolerance=tolerance / 10 if relax_tolerances else None)
 
         else:
 
@@ -1226,9 +1713,58 @@ class Problem(SageObject):
         if check_solution:
             self.check_solution(tolerance=tolerance, show_sorted=show_sorted, show_all=show_all)
 
+    def solve_sdp_async(self, show_output=False, solver="csdp",
+        force_sharp_graphs=False, force_zero_eigenvectors=False,
+        check_solution=True, tolerance=1e-5, show_sorted=False, show_all=False,
+        use_initial_point=False, stream_input=False, relax_tolerances=False):
+        r"""
+        Like ``solve_sdp``, but returns as soon as the SDP solver has been started. The solver's
+        output is followed by a background thread, which reads the solution (and runs
+        ``check_solution`` if asked to) once the solver has finished.
+
+        Returns an ``SDPSolve`` object, which can be used to see whether the solve has finished,
+        to wait for it, or to cancel it. The Problem should not be changed until it has finished.
+
+        It takes the arguments ``show_output``, ``solver``, ``force_sharp_graphs``,
+        ``force_zero_eigenvectors``, ``check_solution``, ``tolerance``, ``show_sorted``,
+        ``show_all``, ``use_initial_point``, ``stream_input`` and ``relax_tolerances``, which mean
+        the same as for ``solve_sdp``. There is no ``import_solution_file``, as an imported
+        solution does not need the solver to be run; use ``solve_sdp`` for that.
+        """
+        self._prepare_sdp_solver_input(solver=solver, force_sharp_graphs=force_sharp_graphs,
+                                       force_zero_eigenvectors=force_zero_eigenvectors,
+                                       use_initial_point=use_initial_point, stream_input=stream_input)
+        p = self._start_sdp_solver(solver=solver, use_initial_point=use_initial_point,
+                                   solver_tolerance=tolerance / 10 if relax_tolerances else None)
+
+        def complete(solve):
+            self._wait_for_sdp_solver(p, show_output=show_output, solver=solver)
+            if solve.cancelled():
+                return
+            self._read_sdp_output_file()
+            if check_solution:
+                self.check_solution(tolerance=tolerance, show_sorted=show_sorted, show_all=show_all)
+
+        return SDPSolve(p, self._sdp_solver_log, complete)
+
+    def _prepare_sdp_solver_input(self, solver="csdp", force_sharp_graphs=False, force_zero_eigenvectors=False,
+                                  use_initial_point=False, stream_input=False):
+
+        if stream_input:
+            if solver != "csdp":
+                raise ValueError("stream_input can only be used with csdp.")
+            self.write_sdp_input_file(force_sharp_graphs=force_sharp_graphs,
+                                      force_zero_eigenvectors=force_zero_eigenvectors, stream=True)
+        # The input file will not be there if the SDP was streamed last time.
+        elif self.state("write_sdp_input_file") != "yes" or not os.path.isfile(self._sdp_input_filename):
+            self.write_sdp_input_file(force_sharp_graphs=force_sharp_graphs,
+                                      force_zero_eigenvectors=force_zero_eigenvectors)
+        if use_initial_point and self.state("write_sdp_initial_point_file") != "yes":
+            self.write_sdp_initial_point_file()
+
     # TODO: add option for forcing sharps
 
-    def write_sdp_input_file(self, force_sharp_graphs=False, force_zero_eigenvectors=False):
+    def write_sdp_input_file(self, force_sharp_graphs=False, force_zero_eigenvectors=False, stream=False):
         r"""
         Writes an input file for the SDP solver, specifying the SDP to be solved. This method is
         by default called by ``solve_sdp``.
@@ -1238,9 +1774,12 @@ class Problem(SageObject):
          - ``force_sharp_graphs`` - Boolean (default: False). If True, then the SDP is set up so
            that graphs that are supposed to be sharp are not given any "slack". Generally, this
            option is not particularly useful. It can sometimes improve the "quality" of a solution.
+
+         - ``stream`` - Boolean (default: False). If True, then a named pipe is made instead of
+           a file, and the SDP is written into it by a background thread, as the SDP solver reads
+           it. The solver must be CSDP, which reads the input twice, and must be started by
+           ``_run_sdp_solver``.
         """
-        num_graphs = len(self._graphs)
-        num_types = len(self._types)
         num_active_densities = len(self._active_densities)
         num_density_coeff_blocks = len(self._density_coeff_blocks)
 
@@ -1252,6 +1791,64 @@ class Problem(SageObject):
 
         if self.state("set_block_matrix_structure") != "yes":
             self._set_block_matrix_structure()
+
+        self.state("write_sdp_input_file", "yes")
+
+        self._sdp_input_filename = os.path.join(self._working_directory(), "sdp.dat-s")
+        if os.path.exists(self._sdp_input_filename):
+            os.remove(self._sdp_input_filename)
+
+        if stream:
+            sys.stdout.write("Streaming SDP input...\n")
+            os.mkfifo(self._sdp_input_filename)
+            self._sdp_input_writer = threading.Thread(target=self._stream_sdp_input,
+                                                      args=(2, force_sharp_graphs, force_zero_eigenvectors))
+            self._sdp_input_writer.daemon = True
+            self._sdp_input_writer.start()
+            return
+
+        sys.stdout.write("Writing SDP input file...\n")
+
+        with open(self._sdp_input_filename, "w") as f:
+            self._write_sdp_input(f, force_sharp_graphs, force_zero_eigenvectors)
+
+    def _stream_sdp_input(self, passes, force_sharp_graphs, force_zero_eigenvectors):
+        """
+        Writes the SDP into the named pipe passes times. Each time, opening the pipe waits
+        until the solver opens it. Stops if the solver closes the pipe early.
+        """
+        try:
+            for i in range(passes):
+                with open(self._sdp_input_filename, "w") as f:
+                    self._write_sdp_input(f, force_sharp_graphs, force_zero_eigenvectors)
+        except IOError:
+            pass
+
+    def _finish_sdp_input_stream(self):
+        """
+        Waits for the thread writing into the named pipe to stop, and removes the pipe. If the
+        solver has stopped reading, the thread is woken up by opening the pipe here.
+        """
+        writer = getattr(self, "_sdp_input_writer", None)
+        if writer is None:
+            return
+
+        while writer.is_alive():
+            try:
+                fd = os.open(self._sdp_input_filename, os.O_RDONLY | os.O_NONBLOCK)
+                os.close(fd)
+            except OSError:
+                pass
+            writer.join(0.1)
+
+        self._sdp_input_writer = None
+        os.remove(self._sdp_input_filename)
+
+    def _write_sdp_input(self, f, force_sharp_graphs, force_zero_eigenvectors):
+
+        num_graphs = len(self._graphs)
+        num_active_densities = len(self._active_densities)
+        num_density_coeff_blocks = len(self._density_coeff_blocks)
         total_num_blocks = len(self._block_matrix_structure)
 
         if force_zero_eigenvectors:
@@ -1259,94 +1856,87 @@ class Problem(SageObject):
         else:
             num_extra_matrices = 0
 
-        self.state("write_sdp_input_file", "yes")
-
-        self._sdp_input_filename = os.path.join(unicode(SAGE_TMP), "sdp.dat-s")
-
-        sys.stdout.write("Writing SDP input file...\n")
+        f.write("%d\n" % (num_graphs + num_density_coeff_blocks + num_extra_matrices,))
+        f.write("%d\n" % (total_num_blocks + 3 + (1 if force_zero_eigenvectors else 0),))
 
-        with open(self._sdp_input_filename, "w") as f:
+        f.write("1 ")
+        for b in self._block_matrix_structure:
+            f.write("%d " % b[1])
 
-            f.write("%d\n" % (num_graphs + num_density_coeff_blocks + num_extra_matrices,))
-            f.write("%d\n" % (total_num_blocks + 3 + (1 if force_zero_eigenvectors else 0),))
+        f.write("-%d -%d" % (num_graphs, num_active_densities))
+        if force_zero_eigenvectors:
+            f.write(" -%d" % num_extra_matrices)
+        f.write("\n")
 
-            f.write("1 ")
-            for b in self._block_matrix_structure:
-                f.write("%d " % b[1])
+        f.write("0.0 " * num_graphs)
+        f.write("1.0 " * num_density_coeff_blocks)
+        f.write("0.0 " * num_extra_matrices)
+        f.write("\n")
 
-            f.write("-%d -%d" % (num_graphs, num_active_densities))
-            if force_zero_eigenvectors:
-                f.write(" -%d" % num_extra_matrices)
-            f.write("\n")
+        if not self._minimize:
+            f.write("0 1 1 1 -1.0\n")
+        else:
+            f.write("0 1 1 1 1.0\n")
 
-            f.write("0.0 " * num_graphs)
-            f.write("1.0 " * num_density_coeff_blocks)
-            f.write("0.0 " * num_extra_matrices)
-            f.write("\n")
+        if force_zero_eigenvectors:
+            for mi in range(num_extra_matrices):
+                f.write("0 %d %d %d %s\n" % (total_num_blocks + 4, mi + 1, mi + 1, "1.0" if self._minimize else "-1.0"))
 
+        for i in range(num_graphs):
             if not self._minimize:
-                f.write("0 1 1 1 -1.0\n")
+                f.write("%d 1 1 1 -1.0\n" % (i + 1,))
             else:
-                f.write("0 1 1 1 1.0\n")
+                f.write("%d 1 1 1 1.0\n" % (i + 1,))
+            if not (force_sharp_graphs and i in self._sharp_graphs):
+                f.write("%d %d %d %d 1.0\n" % (i + 1, total_num_blocks + 2, i + 1, i + 1))
+
+        for i in range(num_graphs):
+            for j in range(num_active_densities):
+                d = self._densities[self._active_densities[j]][i]
+                if d != 0:
+                    if self._minimize:
+                        d *= -1
+                    f.write("%d %d %d %d %s\n" % (i + 1, total_num_blocks + 3, j + 1, j + 1, d.n(digits=64)))
+
+        for i in range(num_density_coeff_blocks):
+            for di in self._density_coeff_blocks[i]:
+                if di in self._active_densities:
+                    j = self._active_densities.index(di)
+                    f.write("%d %d %d %d 1.0\n" % (num_graphs + i + 1, total_num_blocks + 3, j + 1, j + 1))
 
-            if force_zero_eigenvectors:
-                for mi in range(num_extra_matrices):
-                    f.write("0 %d %d %d %s\n" % (total_num_blocks + 4, mi + 1, mi + 1, "1.0" if self._minimize else "-1.0"))
+        for ti in self._active_types:
 
-            for i in range(num_graphs):
-                if not self._minimize:
-                    f.write("%d 1 1 1 -1.0\n" % (i + 1,))
-                else:
-                    f.write("%d 1 1 1 1.0\n" % (i + 1,))
-                if not (force_sharp_graphs and i in self._sharp_graphs):
-                    f.write("%d %d %d %d 1.0\n" % (i + 1, total_num_blocks + 2, i + 1, i + 1))
+            num_blocks, block_sizes, block_offsets, block_indices = self._get_block_matrix_structure(ti)
+            denominator = self._product_densities_denominators[ti]
+            rarray = self._product_densities_arrays[ti]
+            if len(rarray) == 0:
+                continue
 
-            for i in range(num_graphs):
-                for j in range(num_active_densities):
-                    d = self._densities[self._active_densities[j]][i]
-                    if d != 0:
-                        if self._minimize:
-                            d *= -1
-                        f.write("%d %d %d %d %s\n" % (i + 1, total_num_blocks + 3, j + 1, j + 1, d.n(digits=64)))
-
-            for i in range(num_density_coeff_blocks):
-                for di in self._density_coeff_blocks[i]:
-                    if di in self._active_densities:
-                        j = self._active_densities.index(di)
-                        f.write("%d %d %d %d 1.0\n" % (num_graphs + i + 1, total_num_blocks + 3, j + 1, j + 1))
+            # Each row goes in the last block that starts at or before its flag j.
+            bis = numpy.searchsorted(block_offsets, rarray[:, 1], side="right") - 1
+            offsets = numpy.array(block_offsets)[bis]
 
-            for ti in self._active_types:
+            # There are few different counts, so each value is only formatted once.
+            numerators, inverse = numpy.unique(rarray[:, 3], return_inverse=True)
+            value_strings = numpy.array([str((Integer(x) / denominator).n(digits=64)) for x in numerators])
 
-                num_blocks, block_sizes, block_offsets, block_indices = self._get_block_matrix_structure(ti)
+            write_sdpa_entries(f, rarray[:, 0] + 1, numpy.array(block_indices)[bis] + 2,
+                               rarray[:, 1] - offsets + 1, rarray[:, 2] - offsets + 1, value_strings[inverse])
 
-                for row in self._product_densities_arrays[ti]:
-                    gi = row[0]
-                    j = row[1]
-                    k = row[2]
-                    bi = num_blocks - 1
-                    if bi > 0:
-                        while block_offsets[bi] > j:
-                            bi -= 1
-                        j -= block_offsets[bi]
-                        k -= block_offsets[bi]
-                    value = Integer(row[3]) / Integer(row[4])
-                    f.write("%d %d %d %d %s\n" %
-                            (gi + 1, block_indices[bi] + 2, j + 1, k + 1, value.n(digits=64)))
-
-            # TODO: get working with blocks, inactive types
-            if force_zero_eigenvectors:
-                mi = 0
-                for ti in self._active_types:
-                    nf = len(self._flags[ti])
-                    for zi in range(self._zero_eigenvectors[ti].nrows()):
-                        for j in range(nf):
-                            for k in range(j, nf):
-                                value = self._zero_eigenvectors[ti][zi, j] * self._zero_eigenvectors[ti][zi, k]
-                                if value != 0:
-                                    f.write("%d %d %d %d %s\n" %
-                                            (num_graphs + num_density_coeff_blocks + mi + 1, ti + 2, j + 1, k + 1, value.n(digits=64)))
-                        f.write("%d %d %d %d -1.0\n" % (num_graphs + num_density_coeff_blocks + mi + 1, total_num_blocks + 4, mi + 1, mi + 1))
-                        mi += 1
+        # TODO: get working with blocks, inactive types
+        if force_zero_eigenvectors:
+            mi = 0
+            for ti in self._active_types:
+                nf = len(self._flags[ti])
+                for zi in range(self._zero_eigenvectors[ti].nrows()):
+                    for j in range(nf):
+                        for k in range(j, nf):
+                            value = self._zero_eigenvectors[ti][zi, j] * self._zero_eigenvectors[ti][zi, k]
+                            if value != 0:
+                                f.write("%d %d %d %d %s\n" %
+                                        (num_graphs + num_density_coeff_blocks + mi + 1, ti + 2, j + 1, k + 1, value.n(digits=64)))
+                    f.write("%d %d %d %d -1.0\n" % (num_graphs + num_density_coeff_blocks + mi + 1, total_num_blocks + 4, mi + 1, mi + 1))
+                    mi += 1
 
     # TODO: handle no sharp graphs
 
@@ -1369,7 +1959,7 @@ class Problem(SageObject):
         num_types = len(self._types)
         num_active_densities = len(self._active_densities)
 
-        self._sdp_initial_point_filename = os.path.join(unicode(SAGE_TMP), "sdp.ini-s")
+        self._sdp_initial_point_filename = os.path.join(self._working_directory(), "sdp.ini-s")
 
         if self.state("set_block_matrix_structure") != "yes":
             self._set_block_matrix_structure()
@@ -1401,6 +1991,7 @@ class Problem(SageObject):
 
                     nf = len(self._flags[ti])
                     z_matrix = matrix(self._field, nf, nf)
+                    denominator = self._product_densities_denominators[ti]
 
                     for row in self._product_densities_arrays[ti]:
                         gi = row[0]
@@ -1409,7 +2000,7 @@ class Problem(SageObject):
                         si = self._sharp_graphs.index(gi)
                         j = row[1]
                         k = row[2]
-                        value = Integer(row[3]) / Integer(row[4])
+                        value = Integer(row[3]) / denominator
                         z_matrix[j, k] += value * self._sharp_graph_densities[si]
 
                     for j in range(nf):
@@ -1517,50 +2108,104 @@ class Problem(SageObject):
 
     # TODO: report error if problem infeasible
 
-    def _run_sdp_solver(self, show_output=False, solver="csdp", use_initial_point=False):
+    def _run_sdp_solver(self, show_output=False, solver="csdp", use_initial_point=False, solver_tolerance=None):
+
+        p = self._start_sdp_solver(solver=solver, use_initial_point=use_initial_point, solver_tolerance=solver_tolerance)
+        self._wait_for_sdp_solver(p, show_output=show_output, solver=solver)
+
+    def _start_sdp_solver(self, solver="csdp", use_initial_point=False, solver_tolerance=None):
+        """
+        Starts the SDP solver, and returns the pexpect process. If solver_tolerance is not None,
+        and a construction has been set, then CSDP's tolerances are loosened to solver_tolerance.
+        """
+        if solver_tolerance is not None and solver != "csdp":
+            raise ValueError("relax_tolerances can only be used with csdp.")
 
         self.state("run_sdp_solver", "yes")
 
-        previous_directory = os.getcwd()
-        os.chdir(unicode(SAGE_TMP))
+        directory = self._working_directory()
+        output_filename = os.path.join(directory, "sdp.out")
+        sdpa_output_filename = os.path.join(directory, "sdpa.out")
+
+        # CSDP reads its parameters from param.csdp in the directory it is run in.
+        param_filename = os.path.join(directory, "param.csdp")
+        if os.path.exists(param_filename):
+            os.remove(param_filename)
+
+        self._sdp_solver_tolerance = None
+        if solver_tolerance is not None:
+            if self.state("set_construction") != "yes":
+                sys.stdout.write("No construction, so the SDP solver tolerances are not relaxed.\n")
+            else:
+                self._sdp_solver_tolerance = solver_tolerance
+                with open(param_filename, "w") as f:
+                    f.write(csdp_params % (solver_tolerance, solver_tolerance, solver_tolerance))
 
         if solver == "csdp":
-            cmd = "%s %s sdp.out" % (cdsp_cmd, self._sdp_input_filename)
+            cmd = "%s %s %s" % (cdsp_cmd, self._sdp_input_filename, output_filename)
 
             if use_initial_point and self.state("write_sdp_initial_point_file") == "yes":
                 cmd += " %s" % self._sdp_initial_point_filename
 
         elif solver == "dsdp":
-            cmd = "%s %s -gaptol 1e-18 -print 1 -save sdp.out" % (dsdp_cmd, self._sdp_input_filename)
+            cmd = "%s %s -gaptol 1e-18 -print 1 -save %s" % (dsdp_cmd, self._sdp_input_filename, output_filename)
 
         elif solver == "sdpa":
-            cmd = "%s -ds %s -o sdpa.out" % (sdpa_cmd, self._sdp_input_filename)
+            cmd = "%s -ds %s -o %s" % (sdpa_cmd, self._sdp_input_filename, sdpa_output_filename)
 
         elif solver == "sdpa_dd":
-            cmd = "%s -ds %s -o sdpa.out" % (sdpa_dd_cmd, self._sdp_input_filename)
+            cmd = "%s -ds %s -o %s" % (sdpa_dd_cmd, self._sdp_input_filename, sdpa_output_filename)
 
         elif solver == "sdpa_qd":
-            cmd = "%s -ds %s -o sdpa.out" % (sdpa_qd_cmd, self._sdp_input_filename)
+            cmd = "%s -ds %s -o %s" % (sdpa_qd_cmd, self._sdp_input_filename, sdpa_output_filename)
 
         else:
             raise ValueError("unknown solver.")
 
         sys.stdout.write("Running SDP solver...\n")
 
+        self._sdp_solver_log = SolverLog(os.path.join(directory, "sdp.log"), solver)
+        return pexpect.spawn(cmd, timeout=60 * 60 * 24 * 7, cwd=directory)
+
+    def _wait_for_sdp_solver(self, p, show_output=False, solver="csdp"):
+        """
+        Follows the output of the SDP solver process p until it finishes, and then puts its
+        solution in sdp.out.
+        """
+        directory = self._working_directory()
+        output_filename = os.path.join(directory, "sdp.out")
+        sdpa_output_filename = os.path.join(directory, "sdpa.out")
+
         # For maximization problems, the objective value returned by the SDP solver
         # must be negated.
         obj_value_factor = 1.0 if self._minimize else -1.0
 
-        p = pexpect.spawn(cmd, timeout=60 * 60 * 24 * 7)
         obj_val = None
-        self._sdp_solver_output = ""
+        log = self._sdp_solver_log
+
+        solver_tolerance = getattr(self, "_sdp_solver_tolerance", None)
+        if solver_tolerance is not None:
+            target = float(self._approximate_field(self._target_bound)) * obj_value_factor
+            reported = False
+
+        # The output is read in blocks, and only the last, unfinished line is carried over.
+        rest = ""
         while True:
-            if p.eof():
-                break
             try:
-                p.expect("\r\n")
-                line = p.before.strip() + "\n"
-                self._sdp_solver_output += line
+                lines = (rest + p.read_nonblocking(size=65536, timeout=p.timeout)).split("\n")
+            except pexpect.EOF:
+                lines = [rest, ""] if rest else [""]
+            except pexpect.TIMEOUT:
+                # The solver has printed nothing for a week, so assume that it has hung.
+                log.close()
+                p.close(force=True)
+                self._finish_sdp_input_stream()
+                raise ValueError("SDP solver produced no output for %d seconds." % p.timeout)
+            rest = lines.pop()
+
+            for line in lines:
+                line = line.strip() + "\n"
+                log.write(line)
 
                 if show_output:
                     sys.stdout.write(line)
@@ -1572,13 +2217,22 @@ class Problem(SageObject):
                 elif "DSDP Solution" in line:  # DSDP: seems to print absolute value
                     obj_val = self._approximate_field(line.split()[-1])
 
-            except pexpect.EOF:
+            progress = log.progress
+            if solver_tolerance is not None and not reported and progress is not None:
+                if progress.gap < solver_tolerance and abs(progress.primal_objective - target) < solver_tolerance:
+                    sys.stdout.write("SDP solver is within %g of the target bound at iteration %d.\n" % (
+                        solver_tolerance, progress.iteration))
+                    reported = True
+
+            if p.eof():
                 break
 
+        log.close()
         p.close()
         self._sdp_solver_returncode = p.exitstatus
+        self._finish_sdp_input_stream()
 
-        sys.stdout.write("Returncode is %d. Objective value is %s.\n" % (
+        sys.stdout.write("Returncode is %s. Objective value is %s.\n" % (
             self._sdp_solver_returncode, obj_val))
 
         # TODO: if program is infeasible, a returncode of 1 is given,
@@ -1586,8 +2240,8 @@ class Problem(SageObject):
 
         if "sdpa" in solver:
 
-            with open("sdpa.out", "r") as inf:
-                with open("sdp.out", "w") as f:
+            with open(sdpa_output_filename, "r") as inf:
+                with open(output_filename, "w") as f:
 
                     found, diagonal = False, False
                     t, row, col = 0, 1, 1
@@ -1630,8 +2284,7 @@ class Problem(SageObject):
                         if col > 1:  # at least one number found...
                             row += 1
 
-        self._sdp_output_filename = os.path.join(unicode(SAGE_TMP), "sdp.out")
-        os.chdir(previous_directory)
+        self._sdp_output_filename = output_filename
 
     # TODO: read in dual solution
 
@@ -1647,36 +2300,51 @@ class Problem(SageObject):
             self._set_block_matrix_structure()
         num_blocks = len(self._block_matrix_structure)
 
+        # Only the records of the primal matrix, which start with "2", are needed.
         with open(self._sdp_output_filename, "r") as f:
+            records = [line for line in f if line.split(None, 1)[:1] == ["2"]]
 
-            self._sdp_Q_matrices = [matrix(self._approximate_field,
-                len(self._flags[ti]), len(self._flags[ti])) for ti in range(num_types)]
-
-            self._sdp_density_coeffs = [self._approximate_field(0) for i in range(num_densities)]
-
-            for line in f:
-                numbers = line.split()
-                if numbers[0] != "2":
-                    continue
-                bi = int(numbers[1]) - 2
-                if bi == num_blocks + 1:
-                    j = int(numbers[2]) - 1
-                    di = self._active_densities[j]
-                    self._sdp_density_coeffs[di] = self._approximate_field(numbers[4])
-                    continue
-                if bi < 0 or bi >= num_blocks:
-                    continue
-                j = int(numbers[2]) - 1
-                k = int(numbers[3]) - 1
-                ti, size, offset = self._block_matrix_structure[bi]
-                j += offset
-                k += offset
-
-                self._sdp_Q_matrices[ti][j, k] = self._approximate_field(numbers[4])
-                self._sdp_Q_matrices[ti][k, j] = self._sdp_Q_matrices[ti][j, k]
+        data = numpy.fromstring("".join(records), sep=" ").reshape(-1, 5)
+        bis = data[:, 1].astype(int) - 2
+        rows = data[:, 2].astype(int) - 1
+        cols = data[:, 3].astype(int) - 1
 
+        # Values are only read as float64 if that is the approximate field.
+        if self._approximate_field == RDF:
+            values = data[:, 4]
+        else:
+            values = [line.split()[4] for line in records]
+
+        self._sdp_density_coeffs = [self._approximate_field(0) for i in range(num_densities)]
+        for i in numpy.nonzero(bis == num_blocks + 1)[0]:
+            di = self._active_densities[rows[i]]
+            self._sdp_density_coeffs[di] = self._approximate_field(values[i])
+
+        is_q = (bis >= 0) & (bis < num_blocks)
+        block_types = numpy.array([b[0] for b in self._block_matrix_structure] + [-1])
+        block_offsets = numpy.array([b[2] for b in self._block_matrix_structure] + [0])
+        tis = numpy.where(is_q, block_types[numpy.where(is_q, bis, num_blocks)], -1)
+        offsets = block_offsets[numpy.where(is_q, bis, num_blocks)]
+        rows += offsets
+        cols += offsets
+
+        arrays = []
         for ti in range(num_types):
-            self._sdp_Q_matrices[ti].set_immutable()
+            nf = len(self._flags[ti])
+            indices = numpy.nonzero(tis == ti)[0]
+            if self._approximate_field == RDF:
+                Q = numpy.zeros((nf, nf))
+                Q[rows[indices], cols[indices]] = values[indices]
+                Q[cols[indices], rows[indices]] = values[indices]
+                arrays.append(Q)
+            else:
+                entries = {}
+                for i in indices:
+                    j, k = int(rows[i]), int(cols[i])
+                    entries[(j, k)] = entries[(k, j)] = self._approximate_field(values[i])
+                arrays.append(matrix(self._approximate_field, nf, nf, entries))
+
+        self._sdp_Q_matrices = ApproximateMatrices(self._approximate_field, arrays)
 
     def check_solution(self, tolerance=1e-5, show_sorted=False, show_all=False):
         r"""
@@ -1707,19 +2375,23 @@ class Problem(SageObject):
 
         sys.stdout.write("Checking numerical bound...\n")
 
-        fbounds = [sum([self._densities[j][i] * self._sdp_density_coeffs[j] for j in range(num_densities)]) for i in range(num_graphs)]
+        if self._approximate_field == RDF:
+            fbounds = [RDF(x) for x in self._float_bounds()]
+        else:
+            fbounds = [sum([self._densities[j][i] * self._sdp_density_coeffs[j] for j in range(num_densities)]) for i in range(num_graphs)]
 
-        for ti in self._active_types:
-            for row in self._product_densities_arrays[ti]:
-                gi, j, k, numer, denom = row
-                d = Integer(numer) / Integer(denom)
-                value = self._sdp_Q_matrices[ti][j, k]
-                if j != k:
-                    d *= 2
-                if not self._minimize:
-                    fbounds[gi] += d * value
-                else:
-                    fbounds[gi] -= d * value
+            for ti in self._active_types:
+                denominator = self._product_densities_denominators[ti]
+                for row in self._product_densities_arrays[ti]:
+                    gi, j, k, numer = row
+                    d = Integer(numer) / denominator
+                    value = self._sdp_Q_matrices[ti][j, k]
+                    if j != k:
+                        d *= 2
+                    if not self._minimize:
+                        fbounds[gi] += d * value
+                    else:
+                        fbounds[gi] -= d * value
 
         if not self._minimize:
             bound = max(fbounds)
@@ -1779,6 +2451,33 @@ class Problem(SageObject):
         for gi in missing_sharp_graphs:
             sys.stdout.write("Warning: graph %d (%s) does not appear to be sharp.\n" % (gi, self._graphs[gi]))
 
+    def _float_bounds(self):
+        r"""
+        Returns a float64 array of the bound that the SDP solution gives for each admissible
+        graph. Each type adds its products, weighted by its Q matrix entries, with one gather
+        and one bincount.
+        """
+        num_graphs = len(self._graphs)
+        num_densities = len(self._densities)
+
+        densities = numpy.array([[float(x) for x in self._densities[j]] for j in range(num_densities)])
+        coeffs = numpy.array([float(x) for x in self._sdp_density_coeffs])
+        fbounds = coeffs.dot(densities) if num_densities > 0 else numpy.zeros(num_graphs)
+
+        sign = 1.0 if not self._minimize else -1.0
+
+        for ti in self._active_types:
+            rarray = self._product_densities_arrays[ti]
+            if len(rarray) == 0:
+                continue
+            Q = self._sdp_Q_matrices.array(ti)
+            js, ks = rarray[:, 1], rarray[:, 2]
+            # off-diagonal entries appear twice in the product
+            d = rarray[:, 3] * numpy.where(js != ks, 2.0, 1.0) / float(self._product_densities_denominators[ti])
+            fbounds += sign * numpy.bincount(rarray[:, 0], weights=d * Q[js, ks], minlength=num_graphs)
+
+        return fbounds
+
     def import_solution(self, directory, complement=False):
         r"""
         Imports a solution found by Flagmatic 1.0 or 1.5.
@@ -1861,8 +2560,8 @@ class Problem(SageObject):
 
             flag_translations.append(ftr)
 
-        self._sdp_Q_matrices = [matrix(self._approximate_field, len(self._flags[ti]),
-                                len(self._flags[ti])) for ti in range(num_types)]
+        Qs = [matrix(self._approximate_field, len(self._flags[ti]), len(self._flags[ti]))
+              for ti in range(num_types)]
 
         try:
             f = open(directory + "/" + flags.out_filename, "r")
@@ -1883,22 +2582,20 @@ class Problem(SageObject):
                 if tj in self._active_types:
                     j = flag_translations[ti][int(numbers[2]) - 1]
                     k = flag_translations[ti][int(numbers[3]) - 1]
-                    self._sdp_Q_matrices[tj][j, k] = numbers[4]
-                    self._sdp_Q_matrices[tj][k, j] = self._sdp_Q_matrices[tj][j, k]
+                    Qs[tj][j, k] = numbers[4]
+                    Qs[tj][k, j] = Qs[tj][j, k]
 
         f.close()
 
         self._sdp_density_coeffs = [1.0]
-
-        for ti in range(num_types):
-            self._sdp_Q_matrices[ti].set_immutable()
+        self._sdp_Q_matrices = ApproximateMatrices(self._approximate_field, Qs)
 
         sys.path.remove(directory)
         sys.dont_write_bytecode = dont_write_bytecode
 
     def make_exact(self, denominator=1024, meet_target_bound=True,
                    protect=None, use_densities=True, use_blocks=True, rank=None, show_changes=False,
-                   check_exact_bound=True, diagonalize=True):
+                   check_exact_bound=True, diagonalize=True, processes=None):
         r"""
         Makes an exact bound for the problem using the approximate floating point bound
         found by the SDP solver.
@@ -1929,7 +2626,8 @@ class Problem(SageObject):
           - ``rank`` - Integer or None (default: None). When computing the DR matrix,
              stop after ``rank`` columns have been found. This can save time in the
              case that the rank of the DR matrix is known (for example, from a previous
-             run).
+             run). The search always stops once the rank reaches the number of sharp
+             graphs.
 
           - ``show_changes`` - Boolean (default: False). When meeting the target bound,
              display the changes being made to the matrix entries and the density
@@ -1941,6 +2639,9 @@ class Problem(SageObject):
           - ``diagonalize`` - Boolean (default: True). Whether to diagonalize the Q
              matrices afterwards. If ``meet_target_bound`` is False, the Q matrices are
              always diagonalized.
+
+          - ``processes`` - Integer or None (default: None). If an integer greater than 1
+             is given, then the bound is checked using that many worker processes.
         """
 
         if meet_target_bound and self.state("set_construction") != "yes":
@@ -2040,51 +2741,69 @@ class Problem(SageObject):
             triples.sort()
             triple_to_index = dict((triples[i], i) for i in range(num_triples))
 
-            R = matrix(self._field, num_sharps, num_triples, sparse=True)
+            R_entries = {}
 
             sys.stdout.write("Constructing R matrix")
 
             # TODO: only use triples that correspond to middle blocks.
 
+            sharp_indices = dict((gi, si) for si, gi in enumerate(self._sharp_graphs))
+            sign = -1 if self._minimize else 1
+
             for ti in self._active_types:
 
-                Ds = [matrix(QQ, len(self._flags[ti]), len(self._flags[ti]))
-                      for si in range(num_sharps)]
+                nf = len(self._flags[ti])
+                q = q_sizes[ti]
+                if q == 0 or num_sharps == 0:
+                    continue
 
-                for row in self._product_densities_arrays[ti]:
-                    gi = row[0]
-                    if not gi in self._sharp_graphs:
-                        continue
-                    si = self._sharp_graphs.index(gi)
-                    j = row[1]
-                    k = row[2]
-                    value = Integer(row[3]) / Integer(row[4])
-                    Ds[si][j, k] = value
-                    Ds[si][k, j] = value
+                # The triples of each type are contiguous, with (j, k) in row-major order.
+                offset = triple_to_index[(ti, 0, 0)]
+                denominator = self._product_densities_denominators[ti]
+                rows = self._product_densities_arrays[ti]
+                rows = rows[numpy.in1d(rows[:, 0], self._sharp_graphs)].tolist()
 
                 if self.state("transform_solution") == "yes":
+
+                    # Each sharp graph gives a symmetric matrix D of product densities, and
+                    # its row of R comes from B.T * D * B. The matrices D are put side by
+                    # side in one sparse matrix, so that this is two matrix products for
+                    # the whole type.
                     B = self._inverse_flag_bases[ti]
-                    for si in range(num_sharps):
-                        Ds[si] = B.T * Ds[si] * B
-
-                for si in range(num_sharps):
-                    for j in range(q_sizes[ti]):
-                        for k in range(j, q_sizes[ti]):
-                            trip = (ti, j, k)
-                            value = Ds[si][j, k]
-                            if j != k:
-                                value *= 2
-                            if self._minimize:
-                                value *= -1
-                            R[si, triple_to_index[trip]] = value
+                    entries = {}
+                    for gi, j, k, numer in rows:
+                        c = sharp_indices[gi] * nf
+                        entries[(j, c + k)] = numer
+                        entries[(k, c + j)] = numer
+                    D = matrix(self._field, nf, num_sharps * nf, entries, sparse=True)
+                    BTD = B.T * D
+                    BTDB = block_matrix(num_sharps, 1, [BTD.submatrix(0, si * nf, q, nf)
+                                                        for si in range(num_sharps)], subdivide=False) * B
+                    values = []
+                    for (row, k), value in BTDB.dict().items():
+                        si, j = divmod(row, q)
+                        if j <= k:
+                            values.append((si, j, k, value))
+
+                else:
+                    values = [(sharp_indices[gi], min(j, k), max(j, k), Integer(numer)) for gi, j, k, numer in rows]
+
+                for si, j, k, value in values:
+                    value = sign * value / denominator
+                    if j != k:
+                        value *= 2
+                    R_entries[(si, offset + j * (2 * q - j - 1) // 2 + k)] = value
 
                 sys.stdout.write(".")
                 sys.stdout.flush()
             sys.stdout.write("\n")
 
+            R = matrix(self._field, num_sharps, num_triples, R_entries, sparse=True)
+
             density_cols_to_use = []
-            DR = matrix(self._field, num_sharps, 0)  # sparsity harms performance too much here
-            EDR = DR.T
+            # The columns of DR, in echelon form. Once there are num_sharps of them, no
+            # further column can be independent, so there is no need to look at any more.
+            EDR = IncrementalEchelonForm(self._field, num_sharps)
 
             sys.stdout.write("Constructing DR matrix")
 
@@ -2093,27 +2812,23 @@ class Problem(SageObject):
 
                 for j in self._active_densities:
 
-                    if not rank is None and DR.ncols() == rank:
+                    if EDR.is_full() or (not rank is None and EDR.rank() == rank):
                         break
 
-                    new_col = matrix(QQ, [[self._densities[j][gi]] for gi in self._sharp_graphs])
-                    if new_col.is_zero():
+                    new_col = [self._densities[j][gi] for gi in self._sharp_graphs]
+                    if all(x == 0 for x in new_col):
                         continue
-                    EDR = EDR.stack(new_col.T)
-                    EDR.echelonize()
-                    if EDR[-1, :].is_zero():
-                        EDR = EDR[:-1, :]
+                    if not EDR.add(new_col):
                         sys.stdout.write("~")
                         sys.stdout.flush()
                         continue
 
-                    DR = DR.augment(new_col)
                     density_cols_to_use.append(j)
                     sys.stdout.write(".")
                     sys.stdout.flush()
 
                 sys.stdout.write("\n")
-                sys.stdout.write("DR matrix (density part) has rank %d.\n" % DR.ncols())
+                sys.stdout.write("DR matrix (density part) has rank %d.\n" % EDR.rank())
 
             col_norms = {}
             for i in range(num_triples):
@@ -2129,30 +2844,29 @@ class Problem(SageObject):
 
             for i in cols_in_order:
 
-                if not rank is None and DR.ncols() == rank:
+                if EDR.is_full() or (not rank is None and EDR.rank() == rank):
                     break
 
                 ti, j, k = triples[i]
                 if ti in protect:  # don't use protected types
                     continue
-                new_col = R[:, i: i + 1]
+                new_col = R.column(i)
                 if new_col.is_zero():
                     continue
-                EDR = EDR.stack(new_col.T)
-                EDR.echelonize()
-                if EDR[-1, :].is_zero():
-                    EDR = EDR[:-1, :]
+                if not EDR.add(new_col):
                     sys.stdout.write("~")
                     sys.stdout.flush()
                     continue
 
-                DR = DR.augment(new_col)
                 cols_to_use.append(i)
                 sys.stdout.write(".")
                 sys.stdout.flush()
 
             sys.stdout.write("\n")
-            sys.stdout.write("DR matrix has rank %d.\n" % DR.ncols())
+            sys.stdout.write("DR matrix has rank %d.\n" % EDR.rank())
+
+            # sparsity harms performance too much here
+            DR = matrix(self._field, EDR.rank(), num_sharps, sum(EDR.vectors, [])).T
 
             T = matrix(self._field, num_sharps, 1)
 
@@ -2204,9 +2918,9 @@ class Problem(SageObject):
             self._exact_Qdash_matrices[ti].set_immutable()
 
         if check_exact_bound:
-            self.check_exact_bound()
+            self.check_exact_bound(diagonalize=diagonalize, processes=processes)
 
-    def check_exact_bound(self, diagonalize=True):
+    def check_exact_bound(self, diagonalize=True, processes=None):
         r"""
         Usually called by ``make_exact``. If the solution was transformed, then computes
         the Q matrices from the Q' matrices. If the solution was adjusted to meet the
@@ -2215,6 +2929,9 @@ class Problem(SageObject):
 
         If ``diagonalize`` is set to True, then ``diagonalize`` will be called at the
         end.
+
+        If ``processes`` is an integer greater than 1, then the exact sums (and the
+        diagonalization) are shared out by type between that many worker processes.
         """
         num_types = len(self._types)
         num_graphs = len(self._graphs)
@@ -2262,17 +2979,21 @@ class Problem(SageObject):
         bounds = [sum([self._densities[j][i] * self._exact_density_coeffs[j]
                   for j in range(num_densities)]) for i in range(num_graphs)]
 
-        for ti in self._active_types:
-            for row in self._product_densities_arrays[ti]:
-                gi, j, k, numer, denom = row
-                d = Integer(numer) / Integer(denom)
-                value = self._exact_Q_matrices[ti][j, k]
-                if j != k:
-                    value *= 2
-                if not self._minimize:
-                    bounds[gi] += d * value
-                else:
-                    bounds[gi] -= d * value
+        if self._field == QQ:
+            self._add_exact_product_sums(bounds, processes)
+        else:
+            for ti in self._active_types:
+                denominator = self._product_densities_denominators[ti]
+                for row in self._product_densities_arrays[ti]:
+                    gi, j, k, numer = row
+                    d = Integer(numer) / denominator
+                    value = self._exact_Q_matrices[ti][j, k]
+                    if j != k:
+                        value *= 2
+                    if not self._minimize:
+                        bounds[gi] += d * value
+                    else:
+                        bounds[gi] -= d * value
 
         if self._field == QQ:
             if not self._minimize:
@@ -2323,15 +3044,55 @@ class Problem(SageObject):
                 sys.stdout.write("%s : graph %d (%s)\n" % (bounds[gi], gi, self._graphs[gi]))
 
         if diagonalize:
-            self.diagonalize()
+            self.diagonalize(processes=processes)
+
+    def _add_exact_product_sums(self, bounds, processes=None):
+        r"""
+        Adds the contributions of the Q matrices to bounds, when the field is QQ. For each
+        type, the denominators of Q are cleared, and the products are summed exactly with
+        integers by ``exact_product_sums``, so that there is only one rational operation for
+        each type and graph. If ``processes`` is an integer greater than 1, then the types
+        are shared out between that many worker processes.
+        """
+        args = []
+        scales = []
+        for ti in self._active_types:
+            Q = self._exact_Q_matrices[ti]
+            lcm = Q.denominator()
+            args.append(([int(x) for x in (lcm * Q).list()], Q.nrows(),
+                         self._product_densities_arrays[ti]))
+            scales.append(lcm * self._product_densities_denominators[ti])
+
+        if processes is None or processes < 2 or len(args) < 2:
+            results = [exact_product_sums(a) for a in args]
+        else:
+            pool = multiprocessing.Pool(processes)
+            try:
+                results = pool.map(exact_product_sums, args, chunksize=1)
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+
+        for scale, (gis, sums) in zip(scales, results):
+            for gi, s in zip(gis, sums):
+                if not self._minimize:
+                    bounds[gi] += Integer(s) / scale
+                else:
+                    bounds[gi] -= Integer(s) / scale
 
-    def diagonalize(self):
+    def diagonalize(self, processes=None):
         r"""
         For each matrix Q, produces a matrix R and a diagonal matrix M such that
         Q = R * M * R.T, where R.T denotes the transpose of R. Usually called from
         ``make_exact``. Note that if the solution has not been adjusted to meet a target
         bound, a simpler method of rounding is performed, and diagonalization is done
         at the same time.
+
+        If ``processes`` is an integer greater than 1, then the matrices are diagonalized
+        in that many worker processes.
         """
 
         self.state("diagonalize", "yes")
@@ -2341,23 +3102,50 @@ class Problem(SageObject):
 
         sys.stdout.write("Diagonalizing")
 
-        for ti in range(len(self._types)):
-            R, M = LDLdecomposition(self._exact_Qdash_matrices[ti])
+        num_types = len(self._types)
+        if processes is None or processes < 2 or num_types < 2:
+            decompositions = []
+            for ti in range(num_types):
+                decompositions.append(LDLdecomposition(self._exact_Qdash_matrices[ti]))
+                sys.stdout.write(".")
+                sys.stdout.flush()
+        else:
+            pool = multiprocessing.Pool(processes)
+            try:
+                decompositions = pool.map(LDLdecomposition, self._exact_Qdash_matrices, chunksize=1)
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        sys.stdout.write("\n")
+
+        for ti in range(num_types):
+            R, M = decompositions[ti]
             self._exact_diagonal_matrices.append(M)
             if self.state("transform_solution") == "yes":
                 R = self._inverse_flag_bases[ti] * R
             self._exact_r_matrices.append(R)
-            sys.stdout.write(".")
-            sys.stdout.flush()
-        sys.stdout.write("\n")
 
         # Q can now be computed as Q = R * M * R.T
 
         sys.stdout.write("Verifying")
 
-        for ti in range(len(self._types)):
-            Q = self._exact_r_matrices[ti] * self._exact_diagonal_matrices[ti] * self._exact_r_matrices[ti].T
-            if Q != self._exact_Q_matrices[ti]:
+        for ti in range(num_types):
+            R = self._exact_r_matrices[ti]
+            M = self._exact_diagonal_matrices[ti]
+            Q = self._exact_Q_matrices[ti]
+            if self._field == QQ:
+                # Clear the denominators, so that the check is a product of integer matrices.
+                dR = R.denominator()
+                dM = M.denominator()
+                dQ = Q.denominator()
+                RZ = (dR * R).change_ring(ZZ)
+                verified = dQ * (RZ * (dM * M).change_ring(ZZ) * RZ.T) == dR ** 2 * dM * (dQ * Q).change_ring(ZZ)
+            else:
+                verified = R * M * R.T == Q
+            if not verified:
                 raise ValueError  # TODO: choose appropriate error
             sys.stdout.write(".")
             sys.stdout.flush()